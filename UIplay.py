@@ -5,6 +5,7 @@ import random
 from game import move_action2move_id, Game, Board
 from mcts import MCTSPlayer
 import time
+import threading
 from config import CONFIG
 
 
@@ -203,11 +204,21 @@ start_player = 1
 player1 = MCTSPlayer(policy_value_net.policy_value_fn,
                      c_puct=5,
                      n_playout=1000,
-                     is_selfplay=0)
+                     is_selfplay=0,
+                     policy_value_batch_function=policy_value_net.policy_value_batch,
+                     n_threads=CONFIG['search_threads'],
+                     transposition_table_size=CONFIG['transposition_table_size'],
+                     time_budget=CONFIG['time_budget'],
+                     memory_limit=CONFIG['tree_memory_mb'] * 2 ** 20)
 player2 = MCTSPlayer(policy_value_net.policy_value_fn,
                      c_puct=5,
                      n_playout=2000,
-                     is_selfplay=0)
+                     is_selfplay=0,
+                     policy_value_batch_function=policy_value_net.policy_value_batch,
+                     n_threads=CONFIG['search_threads'],
+                     transposition_table_size=CONFIG['transposition_table_size'],
+                     time_budget=CONFIG['time_budget'],
+                     memory_limit=CONFIG['tree_memory_mb'] * 2 ** 20)
 
 
 # player2 = Human()
@@ -224,11 +235,24 @@ swicth_player = True
 draw_fire = False
 move_action = ''
 first_button = False
+# AI在后台线程里思考，界面继续刷新和响应事件
+ai_thread = None
+ai_result = {}
+
+
+def ai_think(player, board_copy):
+    # 线程里的异常不会传到主循环，先存起来，由主循环重新抛出
+    try:
+        ai_result['move'] = player.get_action(board_copy)
+    except Exception as e:
+        ai_result['error'] = e
+
+
 while True:
 
     # 填充背景
     screen.blit(bg_image, (0, 0))
-    for image, image_rect in board2image(board=board.state_deque[-1]):
+    for image, image_rect in board2image(board=board.state_list):
         screen.blit(image, image_rect)
     if draw_fire:
         screen.blit(fire_image, fire_rect)
@@ -267,14 +291,25 @@ while True:
         player_in_turn = players[current_player]  # 决定当前玩家的代理
 
     if player_in_turn.agent == 'AI':
-        pygame.display.update()
-        start_time = time.time()
-        move = player_in_turn.get_action(board)  # 当前玩家代理拿到动作
-        print('耗时：', time.time() - start_time)
-        board.do_move(move)  # 棋盘做出改变
-        swicth_player = True
-        draw_fire = False
+        if ai_thread is None:
+            start_time = time.time()
+            # 搜索时会在棋盘上走子和悔棋，交给AI一份副本，界面上的棋盘保持不变
+            ai_thread = threading.Thread(target=ai_think, args=(player_in_turn, board.copy()), daemon=True)
+            ai_thread.start()
+        elif not ai_thread.is_alive():
+            ai_thread = None
+            print('耗时：', time.time() - start_time)
+            if 'error' in ai_result:
+                raise ai_result.pop('error')
+            board.do_move(ai_result.pop('move'))  # 棋盘做出改变
+            swicth_player = True
+            draw_fire = False
     elif player_in_turn.agent == 'HUMAN':
+        if swicth_player:
+            # 等待人走子的时候，AI在后台继续思考
+            for player in players.values():
+                if player.agent == 'AI':
+                    player.start_ponder(board)
         draw_fire = True
         swicth_player = False
         if len(move_action) == 4:
@@ -0,0 +1,154 @@
+"""搜索速度的基准测试，比较不同线程数下固定搜索次数的走子耗时，以及PUCT和Gumbel根节点搜索的耗时和质量"""
+
+
+import argparse
+import random
+import time
+
+import numpy as np
+
+from config import CONFIG
+from game import Board
+from mcts import MCTS, MCTSPlayer
+
+
+# 模拟的策略价值网络，按批次大小休眠一段时间来模拟GPU推理，休眠期间释放GIL
+# 没有安装深度学习框架或者没有训练好的模型时也可以测试搜索本身的开销
+class SimulatedNet(object):
+
+    def __init__(self, latency=0.004, per_item=0.0002):
+        """
+        latency: 每次调用网络的固定耗时（秒）
+        per_item: 批次中每个局面增加的耗时（秒）
+        """
+        self.latency = latency
+        self.per_item = per_item
+
+    def policy_value_batch(self, boards):
+        time.sleep(self.latency + self.per_item * len(boards))
+        results = []
+        for board in boards:
+            # 用盘面哈希做随机种子，同一个局面总是得到相同的输出
+            rng = random.Random(board.zobrist_key)
+            legal_positions = board.availables
+            probs = np.array([rng.random() for _ in legal_positions])
+            results.append((zip(legal_positions, probs / probs.sum()), rng.uniform(-1, 1)))
+        return results
+
+    def policy_value_fn(self, board):
+        return self.policy_value_batch([board])[0]
+
+
+def load_net(use_model):
+    if not use_model:
+        return SimulatedNet()
+    if CONFIG['use_frame'] == 'paddle':
+        from paddle_net import PolicyValueNet
+        return PolicyValueNet(model_file=CONFIG['paddle_model_path'])
+    from pytorch_net import PolicyValueNet
+    return PolicyValueNet(model_file=CONFIG['pytorch_model_path'])
+
+
+def time_move(player, n_moves=1):
+    """从开局开始，返回每步走子的平均耗时"""
+    board = Board()
+    board.init_board()
+    start_time = time.perf_counter()
+    for _ in range(n_moves):
+        move = player.get_action(board)
+        board.do_move(move)
+    return (time.perf_counter() - start_time) / n_moves
+
+
+def bench_threads(net, thread_counts, n_playout, n_moves):
+    """多线程树并行搜索的扩展曲线：线程数 --> 每步耗时和加速比"""
+    print('threads  seconds/move  playouts/s  speedup')
+    base = None
+    for n_threads in thread_counts:
+        player = MCTSPlayer(net.policy_value_fn,
+                            c_puct=CONFIG['c_puct'],
+                            n_playout=n_playout,
+                            policy_value_batch_function=net.policy_value_batch,
+                            n_threads=n_threads)
+        seconds = time_move(player, n_moves)
+        base = base or seconds
+        print('{:>7}  {:>12.3f}  {:>10.0f}  {:>7.2f}'.format(n_threads, seconds, n_playout / seconds, base / seconds))
+
+
+def bench_processes(process_counts, n_playout, n_moves):
+    """根并行搜索的扩展曲线：进程数 --> 每步耗时和加速比，每个进程使用自己的模拟网络"""
+    print('processes  seconds/move  playouts/s  speedup')
+    base = None
+    for n_processes in process_counts:
+        net = SimulatedNet()
+        player = MCTSPlayer(net.policy_value_fn,
+                            c_puct=CONFIG['c_puct'],
+                            n_playout=n_playout,
+                            n_processes=n_processes,
+                            policy_factory=SimulatedNet)
+        if n_processes > 1:
+            # 先走一步让进程池启动，不计入耗时
+            time_move(player)
+        seconds = time_move(player, n_moves)
+        player.close()
+        base = base or seconds
+        print('{:>9}  {:>12.3f}  {:>10.0f}  {:>7.2f}'.format(n_processes, seconds, n_playout / seconds, base / seconds))
+
+
+def bench_root_policy(net, gumbel_playouts, n_playout, n_moves):
+    """
+    比较PUCT和Gumbel根节点搜索：从开局沿参考搜索的走法取n_moves个局面，每个局面用新的搜索树，
+    参考搜索是4倍搜索次数的PUCT，统计每步耗时、选出的走法和参考一致的比例、训练目标和参考访问分布的KL散度
+    模拟网络的输出是随机的，只有加上--model使用训练好的模型时，一致比例和KL散度才能说明搜索质量
+    """
+    def new_mcts(playouts):
+        return MCTS(net.policy_value_fn, CONFIG['c_puct'], playouts,
+                    policy_value_batch_fn=net.policy_value_batch, batch_size=CONFIG['search_batch_size'])
+
+    board = Board()
+    board.init_board()
+    positions = []
+    for _ in range(n_moves):
+        acts, probs = new_mcts(4 * n_playout).get_move_probs(board, temp=1.0)
+        target = np.zeros(2086)
+        target[acts] = probs
+        positions.append((board.copy(), int(np.argmax(target)), target))
+        board.do_move(int(np.argmax(target)))
+
+    print('root policy  playouts  seconds/move  agree    KL')
+    for root_policy, playouts in [('puct', n_playout)] + [('gumbel', n) for n in gumbel_playouts]:
+        seconds = agree = kl = 0
+        for position, best, reference in positions:
+            mcts = new_mcts(playouts)
+            start_time = time.perf_counter()
+            if root_policy == 'gumbel':
+                move, acts, probs = mcts.get_move_gumbel(position, k=CONFIG['gumbel_k'])
+            else:
+                acts, probs = mcts.get_move_probs(position, temp=1.0)
+                move = acts[int(np.argmax(probs))]
+            seconds += time.perf_counter() - start_time
+            target = np.zeros(2086)
+            target[acts] = probs
+            agree += move == best
+            legal = reference > 0
+            kl += np.sum(reference[legal] * np.log(reference[legal] / np.maximum(target[legal], 1e-10)))
+        print('{:>11}  {:>8}  {:>12.3f}  {:>5.2f}  {:>5.2f}'.format(
+            root_policy, playouts, seconds / n_moves, agree / n_moves, kl / n_moves))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='蒙特卡洛树搜索的基准测试')
+    parser.add_argument('--threads', type=int, nargs='+', default=[1, 2, 4, 8, 16])
+    parser.add_argument('--processes', type=int, nargs='+', help='测试根并行搜索的进程数，比如 --processes 1 2 4')
+    parser.add_argument('--playout', type=int, default=CONFIG['play_out'], help='每步的搜索次数')
+    parser.add_argument('--moves', type=int, default=2, help='每个配置走几步取平均')
+    parser.add_argument('--model', action='store_true', help='使用训练好的模型，默认使用模拟网络')
+    parser.add_argument('--gumbel', type=int, nargs='+', help='和PUCT比较的Gumbel搜索次数，比如 --gumbel 50 100 200')
+    args = parser.parse_args()
+
+    if args.gumbel:
+        bench_root_policy(load_net(args.model), args.gumbel, args.playout, args.moves)
+    elif args.processes:
+        bench_processes(args.processes, args.playout, args.moves)
+    else:
+        bench_threads(load_net(args.model), args.threads, args.playout, args.moves)
@@ -0,0 +1,63 @@
+"""有容量上限的LRU缓存，用于合法走子、神经网络评估等以盘面哈希为键的缓存"""
+
+
+import threading
+from collections import OrderedDict
+
+
+class LRUCache(object):
+
+    def __init__(self, capacity):
+        """
+        :param capacity: 最多保存的条目数，为0时不缓存任何内容
+        """
+        self.capacity = capacity
+        self._data = OrderedDict()
+        # 多线程搜索时多个线程会同时读写同一个缓存
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        """命中时把条目移到最近使用的一端"""
+        with self._lock:
+            try:
+                value = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        """超出容量时淘汰最久没有使用的条目"""
+        if self.capacity <= 0:
+            return
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.capacity:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def items(self):
+        """按从最久没有使用到最近使用的顺序返回所有条目"""
+        with self._lock:
+            return list(self._data.items())
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {'size': len(self._data), 'capacity': self.capacity, 'hits': self.hits,
+                'misses': self.misses, 'hit_rate': self.hits / total if total else 0.0}
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
@@ -1,11 +1,11 @@
 """自我对弈收集数据"""
 import random
+import numpy as np
 from collections import deque
-import copy
 import os
 import pickle
 import time
-from game import Board, Game, move_action2move_id, move_id2move_action, flip_map
+from game import Board, Game, move_mirror_id
 from mcts import MCTSPlayer
 from config import CONFIG
 
@@ -31,15 +31,18 @@ class CollectPipeline:
         self.game = Game(self.board)
         # 对弈参数
         self.temp = 1  # 温度
-        self.n_playout = CONFIG['play_out']  # 每次移动的模拟次数
+        # 每次移动的模拟次数，Gumbel搜索用少得多的次数
+        self.n_playout = CONFIG['gumbel_play_out'] if CONFIG['root_policy'] == 'gumbel' else CONFIG['play_out']
         self.c_puct = CONFIG['c_puct']  # u的权重
         self.buffer_size = CONFIG['buffer_size']  # 经验池大小
         self.data_buffer = deque(maxlen=self.buffer_size)
         self.iters = 0
+        self.policy_value_net = None
+        self.model_mtime = None     # 已加载的模型文件的修改时间
         if CONFIG['use_redis']:
             self.redis_cli = my_redis.get_redis_cli()
 
-    # 从主体加载模型
+    # 从主体加载模型，模型文件没有更新时继续使用已有的网络，保留它的评估缓存
     def load_model(self):
         if CONFIG['use_frame'] == 'paddle':
             model_path = CONFIG['paddle_model_path']
@@ -47,16 +50,25 @@ class CollectPipeline:
             model_path = CONFIG['pytorch_model_path']
         else:
             print('暂不支持所选框架')
-        try:
-            self.policy_value_net = PolicyValueNet(model_file=model_path)
-            print('已加载最新模型')
-        except:
+        if self.policy_value_net is None:
             self.policy_value_net = PolicyValueNet()
+            self.mcts_player = MCTSPlayer(self.policy_value_net.policy_value_fn,
+                                          c_puct=self.c_puct,
+                                          n_playout=self.n_playout,
+                                          is_selfplay=1,
+                                          policy_value_batch_function=self.policy_value_net.policy_value_batch,
+                                          batch_size=CONFIG['search_batch_size'],
+                                          memory_limit=CONFIG['tree_memory_mb'] * 2 ** 20,
+                                          root_policy=CONFIG['root_policy'],
+                                          gumbel_k=CONFIG['gumbel_k'])
             print('已加载初始模型')
-        self.mcts_player = MCTSPlayer(self.policy_value_net.policy_value_fn,
-                                      c_puct=self.c_puct,
-                                      n_playout=self.n_playout,
-                                      is_selfplay=1)
+        if os.path.exists(model_path) and os.path.getmtime(model_path) != self.model_mtime:
+            try:
+                self.policy_value_net.load_model(model_path)
+                self.model_mtime = os.path.getmtime(model_path)
+                print('已加载最新模型')
+            except:
+                print('模型加载失败，继续使用当前模型')
 
     def get_equi_data(self, play_data):
         """左右对称变换，扩充数据集一倍，加速一倍训练速度"""
@@ -66,15 +78,8 @@ class CollectPipeline:
             # 原始数据
             extend_data.append(zip_array.zip_state_mcts_prob((state, mcts_prob, winner)))
             # 水平翻转后的数据
-            state_flip = state.transpose([1, 2, 0])
-            state = state.transpose([1, 2, 0])
-            for i in range(10):
-                for j in range(9):
-                    state_flip[i][j] = state[i][8 - j]
-            state_flip = state_flip.transpose([2, 0, 1])
-            mcts_prob_flip = copy.deepcopy(mcts_prob)
-            for i in range(len(mcts_prob_flip)):
-                mcts_prob_flip[i] = mcts_prob[move_action2move_id[flip_map(move_id2move_action[i])]]
+            state_flip = np.ascontiguousarray(state[:, :, ::-1])
+            mcts_prob_flip = mcts_prob[move_mirror_id]
             extend_data.append(zip_array.zip_state_mcts_prob((state_flip, mcts_prob_flip, winner)))
         return extend_data
 
@@ -83,6 +88,7 @@ class CollectPipeline:
         for i in range(n_games):
             self.load_model()  # 从本体处加载最新模型
             winner, play_data = self.game.start_self_play(self.mcts_player, temp=self.temp, is_shown=False)
+            print('评估缓存', self.policy_value_net.eval_cache.stats())
             play_data = list(play_data)[:]
             self.episode_len = len(play_data)
             # 增加数据
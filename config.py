@@ -3,6 +3,17 @@ CONFIG = {
     'dirichlet': 0.2,       # 国际象棋，0.3；日本将棋，0.15；围棋，0.03
     'play_out': 1200,        # 每次移动的模拟次数
     'c_puct': 5,             # u的权重
+    'root_policy': 'puct',   # 自我对弈时根节点的搜索方式，'puct'或'gumbel'（Gumbel top-k加顺序减半，搜索次数少时也能改进策略）
+    'gumbel_play_out': 100,  # root_policy为'gumbel'时每次移动的模拟次数
+    'gumbel_k': 16,          # Gumbel搜索在根节点考虑的候选走法数
+    'search_batch_size': 8,  # 批量搜索时每次送入网络评估的叶子节点数，1表示逐个评估
+    'virtual_loss': 3,       # 批量搜索时给待评估路径加的虚拟损失
+    'search_threads': 4,     # 人机对弈时每步搜索使用的线程数，1表示单线程
+    'transposition_table_size': 50000,  # 人机对弈时搜索置换表的条目数，0表示不使用
+    'time_budget': None,     # 人机对弈时每步的思考时间（秒），None表示只按搜索次数限制
+    'tree_memory_mb': 512,   # 搜索树最多占用的内存（MB），超过时收起访问次数最少的子树，0表示不限制
+    'legal_moves_cache_size': 20000,    # 进程内合法走子LRU缓存的条目数，0表示不使用
+    'eval_cache_size': 50000,   # 神经网络评估结果的LRU缓存条目数，0表示不使用
     'buffer_size': 100000,   # 经验池大小
     'paddle_model_path': 'current_policy.model',      # paddle模型路径
     'pytorch_model_path': 'current_policy.pkl',   # pytorch模型路径
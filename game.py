@@ -3,12 +3,13 @@
 import numpy as np
 import copy
 import time
+from array import array
 from config import CONFIG
-from collections import deque   # 这个队列用来判断长将或长捉
+from cache import LRUCache
 import random
 
 
-# 列表来表示棋盘，红方在上，黑方在下。使用时需要使用深拷贝
+# 列表来表示棋盘，红方在上，黑方在下。只用来构建初始的编码棋盘，不要修改
 state_list_init = [['红车', '红马', '红象', '红士', '红帅', '红士', '红象', '红马', '红车'],
                    ['一一', '一一', '一一', '一一', '一一', '一一', '一一', '一一', '一一'],
                    ['一一', '红炮', '一一', '一一', '一一', '一一', '一一', '红炮', '一一'],
@@ -21,55 +22,56 @@ state_list_init = [['红车', '红马', '红象', '红士', '红帅', '红士',
                    ['黑车', '黑马', '黑象', '黑士', '黑帅', '黑士', '黑象', '黑马', '黑车']]
 
 
-# deque来存储棋盘状态，长度为4
-state_deque_init = deque(maxlen=4)
-for _ in range(4):
-    state_deque_init.append(copy.deepcopy(state_list_init))
+# 引擎内部使用的棋子编码：红方为正，黑方为负，0表示空位
+# 编码的绝对值减一就是神经网络输入的平面序号
+ROOK, HORSE, ELEPHANT, ADVISOR, KING, CANNON, PAWN = 1, 2, 3, 4, 5, 6, 7
+string2code = dict(红车=1, 红马=2, 红象=3, 红士=4, 红帅=5, 红炮=6, 红兵=7,
+                   黑车=-1, 黑马=-2, 黑象=-3, 黑士=-4, 黑帅=-5, 黑炮=-6, 黑兵=-7,
+                   一一=0)
+code2string = {code: string for string, code in string2code.items()}
+# 颜色到棋子编码符号的映射
+color2sign = {'红': 1, '黑': -1}
 
 
-# 构建一个字典：字符串到数组的映射，函数：数组到字符串的映射
-string2array = dict(红车=np.array([1, 0, 0, 0, 0, 0, 0]), 红马=np.array([0, 1, 0, 0, 0, 0, 0]),
-                    红象=np.array([0, 0, 1, 0, 0, 0, 0]), 红士=np.array([0, 0, 0, 1, 0, 0, 0]),
-                    红帅=np.array([0, 0, 0, 0, 1, 0, 0]), 红炮=np.array([0, 0, 0, 0, 0, 1, 0]),
-                    红兵=np.array([0, 0, 0, 0, 0, 0, 1]), 黑车=np.array([-1, 0, 0, 0, 0, 0, 0]),
-                    黑马=np.array([0, -1, 0, 0, 0, 0, 0]), 黑象=np.array([0, 0, -1, 0, 0, 0, 0]),
-                    黑士=np.array([0, 0, 0, -1, 0, 0, 0]), 黑帅=np.array([0, 0, 0, 0, -1, 0, 0]),
-                    黑炮=np.array([0, 0, 0, 0, 0, -1, 0]), 黑兵=np.array([0, 0, 0, 0, 0, 0, -1]),
-                    一一=np.array([0, 0, 0, 0, 0, 0, 0]))
+# 列表棋盘状态到编码棋盘状态，编码棋盘是长度为90的int8数组，下标为 y * 9 + x
+def state_list2board_array(state_list):
+    return array('b', [string2code[state_list[y][x]] for y in range(10) for x in range(9)])
 
 
-def array2string(array):
-    return list(filter(lambda string: (string2array[string] == array).all(), string2array))[0]
+# 编码棋盘状态到列表棋盘状态，只在界面显示和打印时按需构建
+def board_array2state_list(board_array):
+    return [[code2string[board_array[y * 9 + x]] for x in range(9)] for y in range(10)]
 
 
-# 改变棋盘状态
-def change_state(state_list, move):
-    """move : 字符串'0010'"""
-    copy_list = copy.deepcopy(state_list)
-    y, x, toy, tox = int(move[0]), int(move[1]), int(move[2]), int(move[3])
-    copy_list[toy][tox] = copy_list[y][x]
-    copy_list[y][x] = '一一'
-    return copy_list
+board_array_init = state_list2board_array(state_list_init)
 
 
-# 打印盘面，可视化用到
-def print_board(_state_array):
-    # _state_array: [10, 9, 7], HWC
-    board_line = []
-    for i in range(10):
-        for j in range(9):
-            board_line.append(array2string(_state_array[i][j]))
-        print(board_line)
-        board_line.clear()
+# Zobrist哈希，每个(棋子编码, 格子)对应一个64位随机数，下标为code + 7，空位那一行全为0
+# 使用固定的种子，保证不同进程得到的哈希值一致，可以用作置换表、评估缓存和数据去重的键
+_zobrist_random = random.Random(20220601)
+zobrist_table = [[0 if code == 0 else _zobrist_random.getrandbits(64) for _ in range(90)]
+                 for code in range(-7, 8)]
+# 轮到黑方走子时额外异或的键
+zobrist_side = _zobrist_random.getrandbits(64)
+
 
+# 计算编码棋盘的Zobrist哈希，side为当前走子方的符号
+def get_zobrist_key(board_array, side=1):
+    key = 0 if side == 1 else zobrist_side
+    for sq in range(90):
+        if board_array[sq] != 0:
+            key ^= zobrist_table[board_array[sq] + 7][sq]
+    return key
 
-# 列表棋盘状态到数组棋盘状态
-def state_list2state_array(state_list):
-    _state_array = np.zeros([10, 9, 7])
-    for i in range(10):
-        for j in range(9):
-            _state_array[i][j] = string2array[state_list[i][j]]
-    return _state_array
+
+zobrist_key_init = get_zobrist_key(board_array_init)
+
+
+# 打印盘面，可视化用到
+def print_board(board_array):
+    # board_array: 长度为90的棋子编码数组
+    for board_line in board_array2state_list(board_array):
+        print(board_line)
 
 
 # 拿到所有合法走子的集合，2086长度，也就是神经网络预测的走子概率向量的长度
@@ -119,46 +121,147 @@ def get_all_legal_moves():
 move_id2move_action, move_action2move_id = get_all_legal_moves()
 
 
-# 走子翻转的函数，用来扩充我们的数据
-def flip_map(string):
-    new_str = ''
-    for index in range(4):
-        if index == 0 or index == 2:
-            new_str += (str(string[index]))
-        else:
-            new_str += (str(8 - int(string[index])))
-    return new_str
+# 走子的整数编码，字符串形式只在人机交互时使用
+# move_from_sq/move_to_sq: move_id对应的起点和终点格子，格子编号为 y * 9 + x
+# move_mirror_id: 左右翻转之后的move_id
+# move_id_table: 下标为 起点 * 90 + 终点，值为对应的move_id，不存在的走法为-1
+def get_move_arrays():
+    _from_sq = np.zeros(len(move_id2move_action), dtype=np.int16)
+    _to_sq = np.zeros(len(move_id2move_action), dtype=np.int16)
+    _id_table = np.full(90 * 90, -1, dtype=np.int16)
+    for move_id, action in move_id2move_action.items():
+        _from_sq[move_id] = int(action[0]) * 9 + int(action[1])
+        _to_sq[move_id] = int(action[2]) * 9 + int(action[3])
+        _id_table[_from_sq[move_id] * 90 + _to_sq[move_id]] = move_id
+    mirror_sq = np.arange(90) // 9 * 9 + 8 - np.arange(90) % 9
+    _mirror_id = _id_table[mirror_sq[_from_sq] * 90 + mirror_sq[_to_sq]]
+    return _from_sq, _to_sq, _mirror_id, _id_table
+
+
+move_from_sq, move_to_sq, move_mirror_id, move_id_table = get_move_arrays()
+# 逐个查询时python列表比numpy标量快，do_move等热点路径使用列表版本
+move_from_sq_list, move_to_sq_list = move_from_sq.tolist(), move_to_sq.tolist()
+
+
+# 棋子编码到神经网络输入平面的查找表，code2planes[:, code + 7]是该棋子在0-6平面上的取值
+code2planes = np.zeros([7, 15], dtype=np.float32)
+for _code in range(1, 8):
+    code2planes[_code - 1, _code + 7] = 1
+    code2planes[_code - 1, -_code + 7] = -1
+
+
+# 编码棋盘到神经网络输入，[9, 10, 9]  CHW，平面的含义见Board.current_state
+# 0-6平面通过查找表一次花式索引得到，out可以传入预先分配好的float32缓冲区
+def encode_board_array(board_array, last_move=-1, first_hand=True, out=None):
+    if out is None:
+        out = np.empty([9, 10, 9], dtype=np.float32)
+    planes = out.reshape(9, 90)
+    np.take(code2planes, np.frombuffer(board_array, dtype=np.int8) + 7, axis=1, out=planes[:7])
+    planes[7] = 0
+    if last_move >= 0:
+        planes[7, move_from_sq_list[last_move]] = -1
+        planes[7, move_to_sq_list[last_move]] = 1
+    planes[8] = 1.0 if first_hand else 0.0
+    return out
+
+
+# 批量编码，board_arrays: [N, 90]，last_moves: [N]，first_hands: [N]，返回[N, 9, 10, 9]
+def encode_board_arrays(board_arrays, last_moves, first_hands):
+    board_arrays = np.asarray(board_arrays, dtype=np.int8).reshape(-1, 90)
+    last_moves = np.asarray(last_moves)
+    n = len(board_arrays)
+    out = np.zeros([n, 9, 90], dtype=np.float32)
+    out[:, :7] = np.take(code2planes, board_arrays + 7, axis=1).transpose([1, 0, 2])
+    moved = np.flatnonzero(last_moves >= 0)
+    out[moved, 7, move_from_sq[last_moves[moved]]] = -1
+    out[moved, 7, move_to_sq[last_moves[moved]]] = 1
+    out[np.asarray(first_hands, dtype=bool), 8] = 1.0
+    return out.reshape(n, 9, 10, 9)
+
+
+# 把多个棋盘当前的状态编码成一个批次，供神经网络批量推理
+def get_state_batch(boards):
+    return encode_board_arrays([np.frombuffer(board.board_array, dtype=np.int8) for board in boards],
+                               [board.last_move for board in boards],
+                               [board.action_count % 2 == 0 for board in boards])
 
 
 # 边界检查
 def check_bounds(toY, toX):
-    if toY in [0, 1, 2, 3, 4, 5, 6, 7, 8, 9] and toX in [0, 1, 2, 3, 4, 5, 6, 7, 8]:
-        return True
-    return False
-
-
-# 不能走到自己的棋子位置
-def check_obstruct(piece, current_player_color):
-    # 当走到的位置存在棋子的时候，进行一次判断
-    if piece != '一一':
-        if current_player_color == '红':
-            if '黑' in piece:
-                return True
-            else:
-                return False
-        elif current_player_color == '黑':
-            if '红' in piece:
-                return True
-            else:
-                return False
-    else:
-        return True
-
-
-# 得到当前盘面合法走子集合
-# 输入状态队列不能小于10，current_player_color:当前玩家控制的棋子颜色
+    return 0 <= toY <= 9 and 0 <= toX <= 8
+
+
+# 预先计算每个格子上各兵种的走法表，表中直接存放move_id，走子生成时只需要查表
+# 车和炮：每个格子四个方向的射线，射线是由近到远的(终点, move_id)列表
+# 马：(终点, 马腿, move_id)；象：(终点, 象眼, move_id)，已经去掉了过河的走法
+# 士和帅：九宫之内的(终点, move_id)；兵：(终点, move_id)，过河前只有前进，过河后可以左右走
+# 和颜色有关的表是一个字典，键为颜色的符号，1为红方，-1为黑方
+def get_move_tables():
+    def move_id(from_y, from_x, to_y, to_x):
+        return int(move_id_table[(from_y * 9 + from_x) * 90 + to_y * 9 + to_x])
+
+    in_palace = {1: lambda y, x: 0 <= y <= 2 and 3 <= x <= 5, -1: lambda y, x: 7 <= y <= 9 and 3 <= x <= 5}
+    own_half = {1: lambda y: y <= 4, -1: lambda y: y >= 5}
+    _rays, _horse = [], []
+    _elephant, _advisor, _king, _pawn = {1: [], -1: []}, {1: [], -1: []}, {1: [], -1: []}, {1: [], -1: []}
+    for sq in range(90):
+        y, x = divmod(sq, 9)
+        rays = []
+        for dy, dx in [(0, -1), (0, 1), (-1, 0), (1, 0)]:
+            ray = []
+            toY, toX = y + dy, x + dx
+            while check_bounds(toY, toX):
+                ray.append((toY * 9 + toX, move_id(y, x, toY, toX)))
+                toY, toX = toY + dy, toX + dx
+            rays.append(ray)
+        _rays.append(rays)
+
+        horse = []
+        for dy, dx, leg_y, leg_x in [(-2, -1, -1, 0), (-2, 1, -1, 0), (2, -1, 1, 0), (2, 1, 1, 0),
+                                     (-1, -2, 0, -1), (1, -2, 0, -1), (-1, 2, 0, 1), (1, 2, 0, 1)]:
+            if check_bounds(y + dy, x + dx):
+                horse.append(((y + dy) * 9 + x + dx, (y + leg_y) * 9 + x + leg_x, move_id(y, x, y + dy, x + dx)))
+        _horse.append(horse)
+
+        for side in (1, -1):
+            elephant, advisor, king = [], [], []
+            for dy, dx in [(-1, -1), (-1, 1), (1, -1), (1, 1)]:
+                toY, toX = y + 2 * dy, x + 2 * dx
+                if check_bounds(toY, toX) and own_half[side](y) and own_half[side](toY) \
+                        and move_id(y, x, toY, toX) != -1:
+                    elephant.append((toY * 9 + toX, (y + dy) * 9 + x + dx, move_id(y, x, toY, toX)))
+                toY, toX = y + dy, x + dx
+                if in_palace[side](y, x) and in_palace[side](toY, toX) \
+                        and move_id(y, x, toY, toX) != -1:
+                    advisor.append((toY * 9 + toX, move_id(y, x, toY, toX)))
+            for dy, dx in [(0, -1), (0, 1), (-1, 0), (1, 0)]:
+                toY, toX = y + dy, x + dx
+                if in_palace[side](y, x) and in_palace[side](toY, toX):
+                    king.append((toY * 9 + toX, move_id(y, x, toY, toX)))
+            pawn = []
+            crossed = not own_half[side](y)
+            for dy, dx in [(side, 0), (0, -1), (0, 1)] if crossed else [(side, 0)]:
+                if check_bounds(y + dy, x + dx):
+                    pawn.append(((y + dy) * 9 + x + dx, move_id(y, x, y + dy, x + dx)))
+            _elephant[side].append(elephant)
+            _advisor[side].append(advisor)
+            _king[side].append(king)
+            _pawn[side].append(pawn)
+    return _rays, _horse, _elephant, _advisor, _king, _pawn
+
+
+line_rays, horse_moves, elephant_moves, advisor_moves, king_moves, pawn_moves = get_move_tables()
+
+
+# 进程内共享的合法走子缓存，键为(当前盘面哈希, 三步之前盘面哈希)，不同的搜索路径到达同一个盘面时不用重新生成走子
+legal_moves_cache = LRUCache(CONFIG['legal_moves_cache_size'])
+
+
+# 得到当前盘面符合棋子走法的走子集合，不考虑走完之后己方的帅是否被将军
+# board_array: 当前的编码棋盘，piece_squares: 当前玩家所有棋子所在的格子
+# zobrist_key: 当前盘面的哈希，banned_key: 三步之前盘面的哈希，走子之后不能和它重复（长将或长捉）
 # 用来存放合法走子的列表，例如[0, 1, 2, 1089, 2085]
-def get_legal_moves(state_deque, current_player_color):
+def get_pseudo_legal_moves(board_array, piece_squares, current_player_color, zobrist_key, banned_key):
     """
     ====
       将
@@ -181,476 +284,181 @@ def get_legal_moves(state_deque, current_player_color):
     车
     ====
     这个时候，车就不能再往右走抓帅
-    接下来不能走的动作是(1011)，因为将会盘面与state_deque[-4]重复
+    接下来不能走的动作是(1011)，因为将会盘面与三步之前的盘面重复
+    吃子之后棋子变少，不可能和三步之前的盘面重复，所以只有不吃子的走法需要比较哈希
     """
-
-    state_list = state_deque[-1]
-    old_state_list = state_deque[-4]
-
+    side = color2sign[current_player_color]
     moves = []  # 用来存放所有合法的走子方法
-    face_to_face = False  # 将军面对面
-
-    # 记录将军的位置信息
-    k_x = None
-    k_y = None
-    K_x = None
-    K_y = None
-
-    # state_list是以列表形式表示的, len(state_list) == 10, len(state_list[0]) == 9
-    # 遍历移动初始位置
-    for y in range(10):
-        for x in range(9):
-            # 只有是棋子才可以移动
-            if state_list[y][x] == '一一':
-                pass
+
+    # 遍历当前玩家的棋子
+    for sq in piece_squares:
+        piece = board_array[sq]
+        piece_keys = zobrist_table[piece + 7]
+        # 走子之后一定轮到对方，增量计算走子之后的哈希时先把起点和走子方的键异或进去
+        key = zobrist_key ^ zobrist_side ^ piece_keys[sq]
+        piece = piece * side
+
+        if piece == ROOK:   # 车的合法走子，遇到棋子就停下
+            for ray in line_rays[sq]:
+                for to_sq, move in ray:
+                    target = board_array[to_sq]
+                    if target == 0:
+                        if key ^ piece_keys[to_sq] != banned_key:
+                            moves.append(move)
+                    else:
+                        if target * side < 0:
+                            moves.append(move)
+                        break
+
+        elif piece == CANNON:   # 炮的合法走子，隔一个棋子才能吃子
+            for ray in line_rays[sq]:
+                hits = False
+                for to_sq, move in ray:
+                    target = board_array[to_sq]
+                    if hits is False:
+                        if target != 0:
+                            hits = True
+                        elif key ^ piece_keys[to_sq] != banned_key:
+                            moves.append(move)
+                    elif target != 0:
+                        if target * side < 0:
+                            moves.append(move)
+                        break
+
+        elif piece == HORSE:    # 马走日，不能蹩马腿
+            for to_sq, leg_sq, move in horse_moves[sq]:
+                if board_array[leg_sq] == 0:
+                    target = board_array[to_sq]
+                    if target * side < 0 or (target == 0 and key ^ piece_keys[to_sq] != banned_key):
+                        moves.append(move)
+
+        elif piece == ELEPHANT:     # 象走田，不能塞象眼
+            for to_sq, eye_sq, move in elephant_moves[side][sq]:
+                if board_array[eye_sq] == 0:
+                    target = board_array[to_sq]
+                    if target * side < 0 or (target == 0 and key ^ piece_keys[to_sq] != banned_key):
+                        moves.append(move)
+
+        else:   # 士、帅和兵都只需要检查终点
+            if piece == ADVISOR:
+                table = advisor_moves[side][sq]
+            elif piece == KING:
+                table = king_moves[side][sq]
+                # 将帅面对面，当前玩家可以直接吃掉对方的帅
+                for to_sq, move in line_rays[sq][3 if side == 1 else 2]:
+                    target = board_array[to_sq]
+                    if target != 0:
+                        if target == -side * KING:
+                            moves.append(move)
+                        break
             else:
-                if state_list[y][x] == '黑车' and current_player_color == '黑':  # 黑车的合法走子
-                    toY = y
-                    for toX in range(x - 1, -1, -1):
-                        # 前面是先前位置，后面是移动后的位置
-                        # 这里通过中断for循环实现了车的走子，车不能越过子
-                        m = str(y) + str(x) + str(toY) + str(toX)
-                        if state_list[toY][toX] != '一一':
-                            if '红' in state_list[toY][toX]:
-                                if change_state(state_list, m) != old_state_list:
-                                    moves.append(m)
-                            break
-                        if change_state(state_list, m) != old_state_list:
-                            moves.append(m)
-                    for toX in range(x + 1, 9):
-                        m = str(y) + str(x) + str(toY) + str(toX)
-                        if state_list[toY][toX] != '一一':
-                            if '红' in state_list[toY][toX]:
-                                if change_state(state_list, m) != old_state_list:
-                                    moves.append(m)
-                            break
-                        if change_state(state_list, m) != old_state_list:
-                            moves.append(m)
-
-                    toX = x
-                    for toY in range(y - 1, -1, -1):
-                        m = str(y) + str(x) + str(toY) + str(toX)
-                        if state_list[toY][toX] != '一一':
-                            if '红' in state_list[toY][toX]:
-                                if change_state(state_list, m) != old_state_list:
-                                    moves.append(m)
-                            break
-                        if change_state(state_list, m) != old_state_list:
-                            moves.append(m)
-                    for toY in range(y + 1, 10):
-                        m = str(y) + str(x) + str(toY) + str(toX)
-                        if state_list[toY][toX] != '一一':
-                            if '红' in state_list[toY][toX]:
-                                if change_state(state_list, m) != old_state_list:
-                                    moves.append(m)
-                            break
-                        if change_state(state_list, m) != old_state_list:
-                            moves.append(m)
-
-                elif state_list[y][x] == '红车' and current_player_color == '红':  # 红车的合法走子
-                    toY = y
-                    for toX in range(x - 1, -1, -1):
-                        # 前面是先前位置，后面是移动后的位置
-                        # 这里通过中断for循环实现了，车不能越过子
-                        m = str(y) + str(x) + str(toY) + str(toX)
-                        if state_list[toY][toX] != '一一':
-                            if '黑' in state_list[toY][toX]:
-                                if change_state(state_list, m) != old_state_list:
-                                    moves.append(m)
-                            break
-                        if change_state(state_list, m) != old_state_list:
-                            moves.append(m)
-                    for toX in range(x + 1, 9):
-                        m = str(y) + str(x) + str(toY) + str(toX)
-                        if state_list[toY][toX] != '一一':
-                            if '黑' in state_list[toY][toX]:
-                                if change_state(state_list, m) != old_state_list:
-                                    moves.append(m)
-                            break
-                        if change_state(state_list, m) != old_state_list:
-                            moves.append(m)
-
-                    toX = x
-                    for toY in range(y - 1, -1, -1):
-                        m = str(y) + str(x) + str(toY) + str(toX)
-                        if state_list[toY][toX] != '一一':
-                            if '黑' in state_list[toY][toX]:
-                                if change_state(state_list, m) != old_state_list:
-                                    moves.append(m)
-                            break
-                        if change_state(state_list, m) != old_state_list:
-                            moves.append(m)
-                    for toY in range(y + 1, 10):
-                        m = str(y) + str(x) + str(toY) + str(toX)
-                        if state_list[toY][toX] != '一一':
-                            if '黑' in state_list[toY][toX]:
-                                if change_state(state_list, m) != old_state_list:
-                                    moves.append(m)
-                            break
-                        if change_state(state_list, m) != old_state_list:
-                            moves.append(m)
-
-                # 黑马的合理走法
-                elif state_list[y][x] == '黑马' and current_player_color == '黑':
-                    for i in range(-1, 3, 2):
-                        for j in range(-1, 3, 2):
-                            toY = y + 2 * i
-                            toX = x + 1 * j
-                            if check_bounds(toY, toX) \
-                                    and check_obstruct(state_list[toY][toX], current_player_color='黑') \
-                                    and state_list[toY - i][x] == '一一':
-                                m = str(y) + str(x) + str(toY) + str(toX)
-                                if change_state(state_list, m) != old_state_list:
-                                    moves.append(m)
-                            toY = y + 1 * i
-                            toX = x + 2 * j
-                            if check_bounds(toY, toX) \
-                                    and check_obstruct(state_list[toY][toX], current_player_color='黑') \
-                                    and state_list[y][toX - j] == '一一':
-                                m = str(y) + str(x) + str(toY) + str(toX)
-                                if change_state(state_list, m) != old_state_list:
-                                    moves.append(m)
-
-                # 红马的合理走法
-                elif state_list[y][x] == '红马' and current_player_color == '红':
-                    for i in range(-1, 3, 2):
-                        for j in range(-1, 3, 2):
-                            toY = y + 2 * i
-                            toX = x + 1 * j
-                            if check_bounds(toY, toX) \
-                                    and check_obstruct(state_list[toY][toX], current_player_color='红') \
-                                    and state_list[toY - i][x] == '一一':
-                                m = str(y) + str(x) + str(toY) + str(toX)
-                                if change_state(state_list, m) != old_state_list:
-                                    moves.append(m)
-                            toY = y + 1 * i
-                            toX = x + 2 * j
-                            if check_bounds(toY, toX) \
-                                    and check_obstruct(state_list[toY][toX], current_player_color='红') \
-                                    and state_list[y][toX - j] == '一一':
-                                m = str(y) + str(x) + str(toY) + str(toX)
-                                if change_state(state_list, m) != old_state_list:
-                                    moves.append(m)
-
-                # 黑象的合理走法
-                elif state_list[y][x] == '黑象' and current_player_color == '黑':
-                    for i in range(-2, 3, 4):
-                        toY = y + i
-                        toX = x + i
-                        if check_bounds(toY, toX) \
-                                and check_obstruct(state_list[toY][toX], current_player_color='黑') \
-                                and toY >= 5 and state_list[y + i // 2][x + i // 2] == '一一':
-                            m = str(y) + str(x) + str(toY) + str(toX)
-                            if change_state(state_list, m) != old_state_list:
-                                moves.append(m)
-                        toY = y + i
-                        toX = x - i
-                        if check_bounds(toY, toX) \
-                                and check_obstruct(state_list[toY][toX], current_player_color='黑') \
-                                and toY >= 5 and state_list[y + i // 2][x - i // 2] == '一一':
-                            m = str(y) + str(x) + str(toY) + str(toX)
-                            if change_state(state_list, m) != old_state_list:
-                                moves.append(m)
-
-                # 红象的合理走法
-                elif state_list[y][x] == '红象' and current_player_color == '红':
-                    for i in range(-2, 3, 4):
-                        toY = y + i
-                        toX = x + i
-                        if check_bounds(toY, toX) \
-                                and check_obstruct(state_list[toY][toX], current_player_color='红') \
-                                and toY <= 4 and state_list[y + i // 2][x + i // 2] == '一一':
-                            m = str(y) + str(x) + str(toY) + str(toX)
-                            if change_state(state_list, m) != old_state_list:
-                                moves.append(m)
-                        toY = y + i
-                        toX = x - i
-                        if check_bounds(toY, toX) \
-                                and check_obstruct(state_list[toY][toX], current_player_color='红') \
-                                and toY <= 4 and state_list[y + i // 2][x - i // 2] == '一一':
-                            m = str(y) + str(x) + str(toY) + str(toX)
-                            if change_state(state_list, m) != old_state_list:
-                                moves.append(m)
-
-                # 黑士的合理走法
-                elif state_list[y][x] == '黑士' and current_player_color == '黑':
-                    for i in range(-1, 3, 2):
-                        toY = y + i
-                        toX = x + i
-                        if check_bounds(toY, toX) and check_obstruct(state_list[toY][toX], current_player_color='黑') \
-                                and toY >= 7 and 3 <= toX <= 5:
-                            m = str(y) + str(x) + str(toY) + str(toX)
-                            if change_state(state_list, m) != old_state_list:
-                                moves.append(m)
-                        toY = y + i
-                        toX = x - i
-                        if check_bounds(toY, toX) and check_obstruct(state_list[toY][toX], current_player_color='黑') \
-                                and toY >= 7 and 3 <= toX <= 5:
-                            m = str(y) + str(x) + str(toY) + str(toX)
-                            if change_state(state_list, m) != old_state_list:
-                                moves.append(m)
-
-                # 红士的合理走法
-                elif state_list[y][x] == '红士' and current_player_color == '红':
-                    for i in range(-1, 3, 2):
-                        toY = y + i
-                        toX = x + i
-                        if check_bounds(toY, toX) and check_obstruct(state_list[toY][toX], current_player_color='红') \
-                                and toY <= 2 and 3 <= toX <= 5:
-                            m = str(y) + str(x) + str(toY) + str(toX)
-                            if change_state(state_list, m) != old_state_list:
-                                moves.append(m)
-                        toY = y + i
-                        toX = x - i
-                        if check_bounds(toY, toX) and check_obstruct(state_list[toY][toX], current_player_color='红') \
-                                and toY <= 2 and 3 <= toX <= 5:
-                            m = str(y) + str(x) + str(toY) + str(toX)
-                            if change_state(state_list, m) != old_state_list:
-                                moves.append(m)
-
-                # 黑帅的合理走法
-                elif state_list[y][x] == '黑帅':
-                    k_x = x
-                    k_y = y
-                    if current_player_color == '黑':
-                        for i in range(2):
-                            for sign in range(-1, 2, 2):
-                                j = 1 - i
-                                toY = y + i * sign
-                                toX = x + j * sign
-
-                                if check_bounds(toY, toX) and check_obstruct(
-                                        state_list[toY][toX], current_player_color='黑') and toY >= 7 and 3 <= toX <= 5:
-                                    m = str(y) + str(x) + str(toY) + str(toX)
-                                    if change_state(state_list, m) != old_state_list:
-                                        moves.append(m)
-
-                # 红帅的合理走法
-                elif state_list[y][x] == '红帅':
-                    K_x = x
-                    K_y = y
-                    if current_player_color == '红':
-                        for i in range(2):
-                            for sign in range(-1, 2, 2):
-                                j = 1 - i
-                                toY = y + i * sign
-                                toX = x + j * sign
-
-                                if check_bounds(toY, toX) and check_obstruct(
-                                        state_list[toY][toX], current_player_color='红') and toY <= 2 and 3 <= toX <= 5:
-                                    m = str(y) + str(x) + str(toY) + str(toX)
-                                    if change_state(state_list, m) != old_state_list:
-                                        moves.append(m)
-
-                # 黑炮的合理走法
-                elif state_list[y][x] == '黑炮' and current_player_color == '黑':
-                    toY = y
-                    hits = False
-                    for toX in range(x - 1, -1, -1):
-                        m = str(y) + str(x) + str(toY) + str(toX)
-                        if hits is False:
-                            if state_list[toY][toX] != '一一':
-                                hits = True
-                            else:
-                                if change_state(state_list, m) != old_state_list:
-                                    moves.append(m)
-                        else:
-                            if state_list[toY][toX] != '一一':
-                                if '红' in state_list[toY][toX]:
-                                    if change_state(state_list, m) != old_state_list:
-                                        moves.append(m)
-                                break
-                    hits = False
-                    for toX in range(x + 1, 9):
-                        m = str(y) + str(x) + str(toY) + str(toX)
-                        if hits is False:
-                            if state_list[toY][toX] != '一一':
-                                hits = True
-                            else:
-                                if change_state(state_list, m) != old_state_list:
-                                    moves.append(m)
-                        else:
-                            if state_list[toY][toX] != '一一':
-                                if '红' in state_list[toY][toX]:
-                                    if change_state(state_list, m) != old_state_list:
-                                        moves.append(m)
-                                break
-
-                    toX = x
-                    hits = False
-                    for toY in range(y - 1, -1, -1):
-                        m = str(y) + str(x) + str(toY) + str(toX)
-                        if hits is False:
-                            if state_list[toY][toX] != '一一':
-                                hits = True
-                            else:
-                                if change_state(state_list, m) != old_state_list:
-                                    moves.append(m)
-                        else:
-                            if state_list[toY][toX] != '一一':
-                                if '红' in state_list[toY][toX]:
-                                    if change_state(state_list, m) != old_state_list:
-                                        moves.append(m)
-                                break
-                    hits = False
-                    for toY in range(y + 1, 10):
-                        m = str(y) + str(x) + str(toY) + str(toX)
-                        if hits is False:
-                            if state_list[toY][toX] != '一一':
-                                hits = True
-                            else:
-                                if change_state(state_list, m) != old_state_list:
-                                    moves.append(m)
-                        else:
-                            if state_list[toY][toX] != '一一':
-                                if '红' in state_list[toY][toX]:
-                                    if change_state(state_list, m) != old_state_list:
-                                        moves.append(m)
-                                break
-
-                # 红炮的合理走法
-                elif state_list[y][x] == '红炮' and current_player_color == '红':
-                    toY = y
-                    hits = False
-                    for toX in range(x - 1, -1, -1):
-                        m = str(y) + str(x) + str(toY) + str(toX)
-                        if hits is False:
-                            if state_list[toY][toX] != '一一':
-                                hits = True
-                            else:
-                                if change_state(state_list, m) != old_state_list:
-                                    moves.append(m)
-                        else:
-                            if state_list[toY][toX] != '一一':
-                                if '黑' in state_list[toY][toX]:
-                                    if change_state(state_list, m) != old_state_list:
-                                        moves.append(m)
-                                break
-                    hits = False
-                    for toX in range(x + 1, 9):
-                        m = str(y) + str(x) + str(toY) + str(toX)
-                        if hits is False:
-                            if state_list[toY][toX] != '一一':
-                                hits = True
-                            else:
-                                if change_state(state_list, m) != old_state_list:
-                                    moves.append(m)
-                        else:
-                            if state_list[toY][toX] != '一一':
-                                if '黑' in state_list[toY][toX]:
-                                    if change_state(state_list, m) != old_state_list:
-                                        moves.append(m)
-                                break
-
-                    toX = x
-                    hits = False
-                    for toY in range(y - 1, -1, -1):
-                        m = str(y) + str(x) + str(toY) + str(toX)
-                        if hits is False:
-                            if state_list[toY][toX] != '一一':
-                                hits = True
-                            else:
-                                if change_state(state_list, m) != old_state_list:
-                                    moves.append(m)
-                        else:
-                            if state_list[toY][toX] != '一一':
-                                if '黑' in state_list[toY][toX]:
-                                    if change_state(state_list, m) != old_state_list:
-                                        moves.append(m)
-                                break
-                    hits = False
-                    for toY in range(y + 1, 10):
-                        m = str(y) + str(x) + str(toY) + str(toX)
-                        if hits is False:
-                            if state_list[toY][toX] != '一一':
-                                hits = True
-                            else:
-                                if change_state(state_list, m) != old_state_list:
-                                    moves.append(m)
-                        else:
-                            if state_list[toY][toX] != '一一':
-                                if '黑' in state_list[toY][toX]:
-                                    if change_state(state_list, m) != old_state_list:
-                                        moves.append(m)
-                                break
-
-                # 黑兵的合法走子
-                elif state_list[y][x] == '黑兵' and current_player_color == '黑':
-                    toY = y - 1
-                    toX = x
-                    if check_bounds(toY, toX) and check_obstruct(state_list[toY][toX], current_player_color='黑'):
-                        m = str(y) + str(x) + str(toY) + str(toX)
-                        if change_state(state_list, m) != old_state_list:
-                            moves.append(m)
-                    # 小兵过河
-                    if y < 5:
-                        toY = y
-                        toX = x + 1
-                        if check_bounds(toY, toX) and check_obstruct(state_list[toY][toX], current_player_color='黑'):
-                            m = str(y) + str(x) + str(toY) + str(toX)
-                            if change_state(state_list, m) != old_state_list:
-                                moves.append(m)
-                        toX = x - 1
-                        if check_bounds(toY, toX) and check_obstruct(state_list[toY][toX], current_player_color='黑'):
-                            m = str(y) + str(x) + str(toY) + str(toX)
-                            if change_state(state_list, m) != old_state_list:
-                                moves.append(m)
-
-                # 红兵的合法走子
-                elif state_list[y][x] == '红兵' and current_player_color == '红':
-                    toY = y + 1
-                    toX = x
-                    if check_bounds(toY, toX) and check_obstruct(state_list[toY][toX], current_player_color='红'):
-                        m = str(y) + str(x) + str(toY) + str(toX)
-                        if change_state(state_list, m) != old_state_list:
-                            moves.append(m)
-                    # 小兵过河
-                    if y > 4:
-                        toY = y
-                        toX = x + 1
-                        if check_bounds(toY, toX) and check_obstruct(state_list[toY][toX], current_player_color='红'):
-                            m = str(y) + str(x) + str(toY) + str(toX)
-                            if change_state(state_list, m) != old_state_list:
-                                moves.append(m)
-                        toX = x - 1
-                        if check_bounds(toY, toX) and check_obstruct(state_list[toY][toX], current_player_color='红'):
-                            m = str(y) + str(x) + str(toY) + str(toX)
-                            if change_state(state_list, m) != old_state_list:
-                                moves.append(m)
-
-    if K_x is not None and k_x is not None and K_x == k_x:
-        face_to_face = True
-        for i in range(K_y + 1, k_y, 1):
-            if state_list[i][K_x] != '一一':
-                face_to_face = False
-
-    if face_to_face is True:
-        if current_player_color == '黑':
-            m = str(k_y) + str(k_x) + str(K_y) + str(K_x)
-            if change_state(state_list, m) != old_state_list:
-                moves.append(m)
-        else:
-            m = str(K_y) + str(K_x) + str(k_y) + str(k_x)
-            if change_state(state_list, m) != old_state_list:
-                moves.append(m)
+                table = pawn_moves[side][sq]
+            for to_sq, move in table:
+                target = board_array[to_sq]
+                if target * side < 0 or (target == 0 and key ^ piece_keys[to_sq] != banned_key):
+                    moves.append(move)
+
+    return moves
+
+
+# 由走法表反推的攻击表：attack_xxx[sq]列出能走到sq的格子，马和象附带马腿和象眼
+def get_attack_tables():
+    _horse = [[] for _ in range(90)]
+    _elephant, _advisor, _king, _pawn = [{1: [[] for _ in range(90)], -1: [[] for _ in range(90)]}
+                                         for _ in range(4)]
+    for sq in range(90):
+        for to_sq, leg_sq, _ in horse_moves[sq]:
+            _horse[to_sq].append((sq, leg_sq))
+        for side in (1, -1):
+            for to_sq, eye_sq, _ in elephant_moves[side][sq]:
+                _elephant[side][to_sq].append((sq, eye_sq))
+            for table, attacks in ((advisor_moves, _advisor), (king_moves, _king), (pawn_moves, _pawn)):
+                for to_sq, _ in table[side][sq]:
+                    attacks[side][to_sq].append(sq)
+    return _horse, _elephant, _advisor, _king, _pawn
+
+
+horse_attacks, elephant_attacks, advisor_attacks, king_attacks, pawn_attacks = get_attack_tables()
+
+
+# 判断格子sq是否被side方攻击，也就是side方轮到走子时能否吃掉sq上的棋子
+# 如果sq上是帅，对方的帅在同一列且中间没有棋子时也算被攻击（将帅不能照面）
+def is_attacked(board_array, sq, side):
+    rook, cannon, king = side * ROOK, side * CANNON, side * KING
+    for direction, ray in enumerate(line_rays[sq]):
+        screen = False
+        for to_sq, _ in ray:
+            target = board_array[to_sq]
+            if target != 0:
+                if screen:
+                    if target == cannon:
+                        return True
+                    break
+                if target == rook or (target == king and direction >= 2 and abs(board_array[sq]) == KING):
+                    return True
+                screen = True
+    horse = side * HORSE
+    for from_sq, leg_sq in horse_attacks[sq]:
+        if board_array[from_sq] == horse and board_array[leg_sq] == 0:
+            return True
+    for from_sq in pawn_attacks[side][sq]:
+        if board_array[from_sq] == side * PAWN:
+            return True
+    for from_sq in king_attacks[side][sq]:
+        if board_array[from_sq] == king:
+            return True
+    for from_sq in advisor_attacks[side][sq]:
+        if board_array[from_sq] == side * ADVISOR:
+            return True
+    elephant = side * ELEPHANT
+    for from_sq, eye_sq in elephant_attacks[side][sq]:
+        if board_array[from_sq] == elephant and board_array[eye_sq] == 0:
+            return True
+    return False
 
-    moves_id = []
+
+# 得到当前盘面合法走子集合，在get_pseudo_legal_moves的基础上去掉走完之后己方的帅被将军的走法
+def get_legal_moves(board_array, piece_squares, current_player_color, zobrist_key, banned_key):
+    side = color2sign[current_player_color]
+    moves = get_pseudo_legal_moves(board_array, piece_squares, current_player_color, zobrist_key, banned_key)
+    if side * KING not in board_array:   # 帅已经被吃，对局已经结束
+        return moves
+    king_sq = board_array.index(side * KING)
+    king_y, king_x = divmod(king_sq, 9)
+    in_check = is_attacked(board_array, king_sq, -side)
+    legal_moves = []
     for move in moves:
-        moves_id.append(move_action2move_id[move])
-    return moves_id
+        from_sq, to_sq = move_from_sq_list[move], move_to_sq_list[move]
+        # 没有被将军时，只有走动帅、离开或者走进帅所在的行列（车、炮、对面的帅）、
+        # 离开帅斜对角的格子（马腿）才可能让自己被将军，其余的走法不需要检查
+        from_y, from_x = divmod(from_sq, 9)
+        if not in_check and from_y != king_y and from_x != king_x \
+                and (abs(from_y - king_y) != 1 or abs(from_x - king_x) != 1) \
+                and to_sq // 9 != king_y and to_sq % 9 != king_x:
+            legal_moves.append(move)
+            continue
+        piece, captured = board_array[from_sq], board_array[to_sq]
+        board_array[to_sq], board_array[from_sq] = piece, 0
+        if not is_attacked(board_array, to_sq if from_sq == king_sq else king_sq, -side):
+            legal_moves.append(move)
+        board_array[from_sq], board_array[to_sq] = piece, captured
+    return legal_moves
 
 
 # 棋盘逻辑控制
 class Board(object):
 
     def __init__(self):
-        self.state_list = copy.deepcopy(state_list_init)
+        self.board_array = array('b', board_array_init)
         self.game_start = False
         self.winner = None
-        self.state_deque = copy.deepcopy(state_deque_init)
+        self.zobrist_key = zobrist_key_init
+        self.key_history = [zobrist_key_init] * 4
+        self._availables = None
 
     # 初始化棋盘的方法
-    def init_board(self, start_player=1):   # 传入先手玩家的id
+    # state_list和current_player_color可以指定一个局面开始，用于残局和走子生成的测试
+    def init_board(self, start_player=1, state_list=None, current_player_color='红'):   # 传入先手玩家的id
         # 增加一个颜色到id的映射字典，id到颜色的映射字典
         # 永远是红方先移动
         self.start_player = start_player
@@ -664,78 +472,172 @@ class Board(object):
             self.color2id = {'红': 2, '黑': 1}
             self.backhand_player = 1
         # 当前手玩家，也就是先手玩家
-        self.current_player_color = self.id2color[start_player]     # 红
-        self.current_player_id = self.color2id['红']
-        # 初始化棋盘状态
-        self.state_list = copy.deepcopy(state_list_init)
-        self.state_deque = copy.deepcopy(state_deque_init)
+        self.current_player_color = current_player_color     # 红
+        self.current_player_id = self.color2id[current_player_color]
+        # 初始化棋盘状态，编码棋盘和双方的棋子列表
+        if state_list is None:
+            self.board_array = array('b', board_array_init)
+        else:
+            self.board_array = state_list2board_array(state_list)
+        self.piece_squares = {1: set(), -1: set()}
+        for sq, code in enumerate(self.board_array):
+            if code != 0:
+                self.piece_squares[1 if code > 0 else -1].add(sq)
+        # 盘面哈希和历史盘面的哈希，和原先的state_deque一样预先放入4个初始盘面，用来判断长将或长捉
+        self.zobrist_key = get_zobrist_key(self.board_array, color2sign[current_player_color])
+        self.key_history = [self.zobrist_key] * 4
         # 初始化最后落子位置
         self.last_move = -1
         # 记录游戏中吃子的回合数
         self.kill_action = 0
         self.game_start = False
-        self.action_count = 0   # 游戏动作计数器
+        self.action_count = 0 if current_player_color == '红' else 1   # 游戏动作计数器，黑方先走时从1开始
+        # 神经网络输入的9个平面，[9, 90]，走子时只更新变化的格子
+        self.state_planes = encode_board_array(self.board_array,
+                                               first_hand=self.action_count % 2 == 0).reshape(9, 90)
         self.winner = None
+        # 悔棋栈，记录每一步走子前需要恢复的信息，供undo_move使用
+        self.move_stack = []
+        # 当前盘面合法走子的缓存，走子和悔棋时失效
+        self._availables = None
+
+    # 列表形式的当前盘面，只在界面显示时按需构建
+    @property
+    def state_list(self):
+        return board_array2state_list(self.board_array)
 
     @property
-    # 获的当前盘面的所有合法走子集合
+    # 获的当前盘面的所有合法走子集合，返回的列表会被缓存复用，调用方不要修改它
     def availables(self):
-        return get_legal_moves(self.state_deque, self.current_player_color)
+        if self._availables is None:
+            cache_key = (self.zobrist_key, self.key_history[-4])
+            moves = legal_moves_cache.get(cache_key)
+            if moves is None:
+                moves = get_legal_moves(self.board_array,
+                                        self.piece_squares[color2sign[self.current_player_color]],
+                                        self.current_player_color,
+                                        self.zobrist_key,
+                                        self.key_history[-4])
+                legal_moves_cache.put(cache_key, moves)
+            self._availables = moves
+        return self._availables
 
     # 从当前玩家的视角返回棋盘状态，current_state_array: [9, 10, 9]  CHW
     def current_state(self):
-        _current_state = np.zeros([9, 10, 9])
         # 使用9个平面来表示棋盘状态
         # 0-6个平面表示棋子位置，1代表红方棋子，-1代表黑方棋子, 队列最后一个盘面
         # 第7个平面表示对手player最近一步的落子位置，走子之前的位置为-1，走子之后的位置为1，其余全部是0
         # 第8个平面表示的是当前player是不是先手player，如果是先手player则整个平面全部为1，否则全部为0
-        _current_state[:7] = state_list2state_array(self.state_deque[-1]).transpose([2, 0, 1])  # [7, 10, 9]
-
-        if self.game_start:
-            # 解构self.last_move
-            move = move_id2move_action[self.last_move]
-            start_position = int(move[0]), int(move[1])
-            end_position = int(move[2]), int(move[3])
-            _current_state[7][start_position[0]][start_position[1]] = -1
-            _current_state[7][end_position[0]][end_position[1]] = 1
-        # 指出当前是哪个玩家走子
-        if self.action_count % 2 == 0:
-            _current_state[8][:, :] = 1.0
-
-        return _current_state
+        # 平面在do_move和undo_move中增量维护，这里只需要拷贝一份
+        return self.state_planes.reshape(9, 10, 9).copy()
 
     # 根据move对棋盘状态做出改变
     def do_move(self, move):
-        self.game_start = True  # 游戏开始
         self.action_count += 1  # 移动次数加1
-        move_action = move_id2move_action[move]
-        start_y, start_x = int(move_action[0]), int(move_action[1])
-        end_y, end_x = int(move_action[2]), int(move_action[3])
-        state_list = copy.deepcopy(self.state_deque[-1])
+        self._availables = None
+        from_sq, to_sq = move_from_sq_list[move], move_to_sq_list[move]
+        side = color2sign[self.current_player_color]
+        board_array = self.board_array
+        captured = board_array[to_sq]
+        self.move_stack.append((from_sq, to_sq, captured, self.kill_action, self.winner,
+                                self.last_move, self.game_start))
+        self.game_start = True  # 游戏开始
         # 判断是否吃子
-        if state_list[end_y][end_x] != '一一':
+        if captured != 0:
             # 如果吃掉对方的帅，则返回当前的current_player胜利
             self.kill_action = 0
-            if self.current_player_color == '黑' and state_list[end_y][end_x] == '红帅':
-                self.winner = self.color2id['黑']
-            elif self.current_player_color == '红' and state_list[end_y][end_x] == '黑帅':
-                self.winner = self.color2id['红']
+            if captured == -side * KING:
+                self.winner = self.color2id[self.current_player_color]
+            self.piece_squares[-side].discard(to_sq)
         else:
             self.kill_action += 1
-        # 更改棋盘状态
-        state_list[end_y][end_x] = state_list[start_y][start_x]
-        state_list[start_y][start_x] = '一一'
+        # 更改棋盘状态，同时增量更新哈希
+        piece = board_array[from_sq]
+        self.zobrist_key ^= zobrist_table[piece + 7][from_sq] ^ zobrist_table[piece + 7][to_sq] \
+            ^ zobrist_table[captured + 7][to_sq] ^ zobrist_side
+        board_array[to_sq] = piece
+        board_array[from_sq] = 0
+        self.piece_squares[side].discard(from_sq)
+        self.piece_squares[side].add(to_sq)
+        # 更新神经网络输入平面：被吃的棋子、走动的棋子、最后一步走子和走子方
+        planes = self.state_planes
+        if captured != 0:
+            planes[abs(captured) - 1, to_sq] = 0
+        planes[abs(piece) - 1, from_sq] = 0
+        planes[abs(piece) - 1, to_sq] = side
+        if self.last_move >= 0:
+            planes[7, move_from_sq_list[self.last_move]] = 0
+            planes[7, move_to_sq_list[self.last_move]] = 0
+        planes[7, from_sq] = -1
+        planes[7, to_sq] = 1
+        planes[8] = 1.0 if self.action_count % 2 == 0 else 0.0
         self.current_player_color = '黑' if self.current_player_color == '红' else '红'  # 改变当前玩家
         self.current_player_id = 1 if self.current_player_id == 2 else 2
         # 记录最后一次移动的位置
         self.last_move = move
-        self.state_deque.append(state_list)
+        self.key_history.append(self.zobrist_key)
+
+    # 复制当前局面，比deepcopy快得多，批量评估时用来保存叶子节点的快照
+    def copy(self):
+        board = copy.copy(self)
+        board.board_array = array('b', self.board_array)
+        board.piece_squares = {1: set(self.piece_squares[1]), -1: set(self.piece_squares[-1])}
+        board.key_history = list(self.key_history)
+        board.state_planes = self.state_planes.copy()
+        board.move_stack = list(self.move_stack)
+        return board
+
+    # 撤销最近一次do_move，蒙特卡洛树搜索在同一个棋盘上前进和回退，不再需要深拷贝
+    def undo_move(self):
+        from_sq, to_sq, captured, self.kill_action, self.winner, self.last_move, self.game_start = \
+            self.move_stack.pop()
+        self.key_history.pop()
+        self.zobrist_key = self.key_history[-1]
+        self._availables = None
+        self.action_count -= 1
+        self.current_player_color = '黑' if self.current_player_color == '红' else '红'  # 换回走子的玩家
+        self.current_player_id = 1 if self.current_player_id == 2 else 2
+        side = color2sign[self.current_player_color]
+        board_array = self.board_array
+        piece = board_array[to_sq]
+        board_array[from_sq] = piece
+        board_array[to_sq] = captured
+        self.piece_squares[side].discard(to_sq)
+        self.piece_squares[side].add(from_sq)
+        if captured != 0:
+            self.piece_squares[-side].add(to_sq)
+        # 恢复神经网络输入平面
+        planes = self.state_planes
+        planes[abs(piece) - 1, to_sq] = 0
+        planes[abs(piece) - 1, from_sq] = side
+        if captured != 0:
+            planes[abs(captured) - 1, to_sq] = -side
+        planes[7, from_sq] = 0
+        planes[7, to_sq] = 0
+        if self.last_move >= 0:
+            planes[7, move_from_sq_list[self.last_move]] = -1
+            planes[7, move_to_sq_list[self.last_move]] = 1
+        planes[8] = 1.0 if self.action_count % 2 == 0 else 0.0
+
+    # 当前走子方因为禁止重复局面而不能走的那一步，没有时返回-1
+    # 只有最近三步是对方走出又原路走回、中间己方走了一步不吃子的棋时，己方走回去才会回到key_history[-4]的局面
+    def banned_move(self):
+        if len(self.move_stack) < 3:
+            return -1
+        (from1, to1, captured1) = self.move_stack[-3][:3]
+        (from2, to2, captured2) = self.move_stack[-2][:3]
+        (from3, to3, captured3) = self.move_stack[-1][:3]
+        if captured1 or captured2 or captured3 or from3 != to1 or to3 != from1:
+            return -1
+        return int(move_id_table[to2 * 90 + from2])
 
     # 是否产生赢家
     def has_a_winner(self):
         """一共有三种状态，红方胜，黑方胜，平局"""
         if self.winner is not None:
             return True, self.winner
+        elif not self.availables:   # 被将死或者困毙，没有合法走子的一方判负
+            return True, self.color2id['黑' if self.current_player_color == '红' else '红']
         elif self.kill_action >= CONFIG['kill_action']:  # 平局先手判负
             # return False, -1
             return True, self.backhand_player
@@ -767,7 +669,7 @@ class Game(object):
     def graphic(self, board, player1_color, player2_color):
         print('player1 take: ', player1_color)
         print('player2 take: ', player2_color)
-        print_board(state_list2state_array(board.state_deque[-1]))
+        print_board(board.board_array)
 
     # 用于人机对战，人人对战等
     def start_play(self, player1, player2, start_player=1, is_shown=1):
@@ -841,21 +743,21 @@ class Game(object):
 
 
 if __name__ == '__main__':
-    # 测试array2string
-    # _array = np.array([0, 0, 0, 0, 0, 0, 0])
-    # print(array2num(_array))
-
-    """# 测试change_state
-    new_state = change_state(state_list_init, move='0010')
-    for row in range(10):
-        print(new_state[row])"""
+    """# 测试do_move和undo_move
+    board = Board()
+    board.init_board()
+    board.do_move(move_action2move_id['0010'])
+    print_board(board.board_array)
+    board.undo_move()
+    print_board(board.board_array)"""
 
     """# 测试print_board
-    _state_list = copy.deepcopy(state_list_init)
-    print_board(state_list2state_array(_state_list))"""
+    print_board(state_list2board_array(state_list_init))"""
 
     """# 测试get_legal_moves
-    moves = get_legal_moves(state_deque_init, current_player_color='黑')
+    _board_array = state_list2board_array(state_list_init)
+    moves = get_legal_moves(_board_array, [sq for sq in range(90) if _board_array[sq] < 0], '黑',
+                            get_zobrist_key(_board_array, side=-1), None)
     move_actions = []
     for item in moves:
         move_actions.append(move_id2move_action[item])
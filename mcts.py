@@ -1,195 +1,1065 @@
 """蒙特卡洛树搜索"""
 
 
+import math
+import queue
+import threading
+import time
 import numpy as np
-import copy
+from concurrent.futures import ProcessPoolExecutor
+from cache import LRUCache
 from config import CONFIG
 
 
+# 子节点数不超过这个值时，select_mode='auto'用纯Python计算PUCT，更多时用NumPy一次算完
+# NumPy每次调用有几微秒的固定开销，实测两者在30个子节点左右持平
+SELECT_PYTHON_MAX_CHILDREN = 32
+# 反向更新时路径不超过这个长度用Python循环，更长时用NumPy按下标一次更新，实测10层左右持平
+BACKUP_PYTHON_MAX_DEPTH = 10
+# 反向更新的符号表，从叶子节点往上依次是+1，-1，+1……
+BACKUP_SIGNS = np.array([1.0, -1.0] * 512)
+# 提前结束搜索时，每隔多少次搜索检查一次根节点的访问次数
+EARLY_STOP_CHECK_INTERVAL = 8
+# 一次展开最多新增的边数（中国象棋一个局面的合法走法不超过这个数），搜索树离内存上限不到这么多条边时整理
+MAX_EXPAND_EDGES = 128
+# Gumbel搜索中sigma(q) = (GUMBEL_C_VISIT + 最多的访问次数) * GUMBEL_C_SCALE * q，q归一化到[0, 1]
+GUMBEL_C_VISIT = 50
+GUMBEL_C_SCALE = 1.0
+
+
 def softmax(x):
     probs = np.exp(x - np.max(x))
     probs /= np.sum(probs)
     return probs
 
 
-# 定义叶子节点
-class TreeNode(object):
+# 数组形式的搜索树
+class Tree(object):
     """
-    mcts树中的节点，树的子节点字典中，键为动作，值为TreeNode。记录当前节点选择的动作，以及选择该动作后会跳转到的下一个子节点。
-    每个节点跟踪其自身的Q，先验概率P及其访问次数调整的u
+    搜索树分成边和节点两组连续的数组，都用数组下标表示
+    每条边记录动作action，先验概率P，访问次数N和价值总和W，以及走这一步之后到达的节点child，
+    W从走这一步的一方的视角计算，Q = W / N，和原来TreeNode._Q的含义相同
+    展开一个局面时只在边数组中连续写入所有合法走法的动作和先验概率，child为-1，
+    第一次从这条边往下搜索到叶子并展开时才在节点数组中分配节点，记录它的第一条边first_edge和边数n_edges
+    搜索路径、置换表和对外的接口都用边的下标代表边所到达的局面，称为节点，根节点是第0条边
+    使用置换表时不同的边可以指向同一个节点，反向更新沿着搜索时记录的路径进行
+    max_capacity限制边数组和节点数组的容量，数组扩大时不超过它，搜索树快满时由MCTS调用prune收起一部分子树
     """
 
-    def __init__(self, parent, prior_p):
+    EDGE_ARRAYS = ('N', 'W', 'P', 'action', 'child')
+    NODE_ARRAYS = ('first_edge', 'n_edges')
+
+    def __init__(self, capacity=4096, max_capacity=None):
+        if max_capacity is not None:
+            capacity = min(capacity, max_capacity)
+        self.max_capacity = max_capacity
+        self.capacity = capacity
+        self.N = np.zeros(capacity, dtype=np.int32)
+        self.W = np.zeros(capacity, dtype=np.float64)
+        self.P = np.zeros(capacity, dtype=np.float32)
+        self.action = np.zeros(capacity, dtype=np.int16)
+        self.child = np.zeros(capacity, dtype=np.int32)
+        # 展开过的节点远少于边，节点数组从边数组容量的1/16开始
+        self.node_capacity = max(capacity // 16, 16)
+        self.first_edge = np.zeros(self.node_capacity, dtype=np.int32)
+        self.n_edges = np.zeros(self.node_capacity, dtype=np.int32)
+        self.size = 0
+        self.n_nodes = 0
+        self.reset()
+
+    def reset(self):
+        """清空整棵树，只留下一个还没有展开的根节点"""
+        self.size = 1
+        self.n_nodes = 0
+        self.N[0] = 0
+        self.W[0] = 0
+        self.P[0] = 1.0
+        self.action[0] = -1
+        self.child[0] = -1
+
+    def __len__(self):
+        return self.size
+
+    @classmethod
+    def capacity_for(cls, nbytes):
+        """nbytes字节最多能存放的边数，节点数不会超过边数，按每条边一个节点计算"""
+        tree = cls(16)
+        return nbytes // sum(getattr(tree, name).itemsize for name in cls.EDGE_ARRAYS + cls.NODE_ARRAYS)
+
+    def nbytes(self):
+        """数组已经分配的字节数"""
+        return self.capacity * sum(getattr(self, name).itemsize for name in self.EDGE_ARRAYS) + \
+            self.node_capacity * sum(getattr(self, name).itemsize for name in self.NODE_ARRAYS)
+
+    def _grow(self, names, size, capacity, needed):
+        """容量不够时按倍数扩大一组数组，但不超过max_capacity，已有的下标保持不变，返回新的容量"""
+        capacity = max(needed, capacity * 2)
+        if self.max_capacity is not None:
+            capacity = max(min(capacity, self.max_capacity), needed)
+        for name in names:
+            old = getattr(self, name)
+            new = np.zeros(capacity, dtype=old.dtype)
+            new[:size] = old[:size]
+            setattr(self, name, new)
+        return capacity
+
+    def expand(self, node, action_priors):    # 这里把不合法的动作概率全部设置为0
+        """为node分配一个节点和一段连续的边，边所到达的节点等第一次展开时再分配"""
+        action_priors = list(action_priors)
+        n = len(action_priors)
+        if n == 0 or self.child[node] != -1:
+            return
+        start = self.size
+        end = start + n
+        if end > self.capacity:
+            self.capacity = self._grow(self.EDGE_ARRAYS, self.size, self.capacity, end)
+        if self.n_nodes == self.node_capacity:
+            self.node_capacity = self._grow(self.NODE_ARRAYS, self.n_nodes, self.node_capacity, self.n_nodes + 1)
+        actions, priors = zip(*action_priors)
+        self.action[start:end] = actions
+        self.P[start:end] = priors
+        self.N[start:end] = 0
+        self.W[start:end] = 0
+        self.child[start:end] = -1
+        k = self.n_nodes
+        self.first_edge[k] = start
+        self.n_edges[k] = n
+        self.child[node] = k
+        self.n_nodes = k + 1
+        self.size = end
+
+    def is_leaf(self, node):
+        """检查是否是叶节点，即没有被扩展的节点"""
+        return self.child[node] == -1
+
+    def edge_range(self, node):
+        """返回node所有子节点（出边）在边数组中的起止下标，叶子节点返回(0, 0)"""
+        k = self.child[node]
+        if k == -1:
+            return 0, 0
+        start = int(self.first_edge[k])
+        return start, start + int(self.n_edges[k])
+
+    def select(self, node, c_puct, select_mode='auto'):
         """
-        :param parent: 当前节点的父节点
-        :param prior_p:  当前节点被选择的先验概率
+        在子节点中选择能够提供最大的Q+U的节点，U = c_puct * P * sqrt(N_parent) / (1 + N)
+        没有访问过的子节点N = W = 0，只有先验概率一项
+        select_mode: 'numpy'对所有子节点做一次向量运算，'python'逐个计算，'auto'按子节点数自动选择
+        return: (action, child)的二元组
         """
-        self._parent = parent
-        self._children = {} # 从动作到TreeNode的映射
-        self._n_visits = 0  # 当前当前节点的访问次数
-        self._Q = 0         # 当前节点对应动作的平均动作价值
-        self._u = 0         # 当前节点的置信上限         # PUCT算法
-        self._P = prior_p
+        start, end = self.edge_range(node)
+        n_children = end - start
+        sqrt_n = math.sqrt(self.N[node])
+        if select_mode == 'numpy' or (select_mode == 'auto' and n_children > SELECT_PYTHON_MAX_CHILDREN):
+            n = self.N[start:end]
+            score = self.W[start:end] / np.maximum(n, 1) + c_puct * self.P[start:end] * sqrt_n / (1 + n)
+            child = start + int(score.argmax())
+        else:
+            n = self.N[start:end].tolist()
+            w = self.W[start:end].tolist()
+            p = self.P[start:end].tolist()
+            best_score = -math.inf
+            best = 0
+            for i in range(n_children):
+                score = w[i] / (n[i] or 1) + c_puct * p[i] * sqrt_n / (1 + n[i])
+                if score > best_score:
+                    best_score = score
+                    best = i
+            child = start + best
+        return int(self.action[child]), child
 
-    def expand(self, action_priors):    # 这里把不合法的动作概率全部设置为0
-        """通过创建新子节点来展开树"""
-        for action, prob in action_priors:
-            if action not in self._children:
-                self._children[action] =  TreeNode(self, prob)
+    def update_path(self, path, leaf_value):
+        """沿着从根节点到叶子节点的路径反向更新，leaf_value是叶子节点（路径最后一个节点）的值，每上一层取反"""
+        N, W = self.N, self.W
+        depth = len(path)
+        if BACKUP_PYTHON_MAX_DEPTH < depth <= len(BACKUP_SIGNS):
+            # 路径上不会有重复的节点，可以直接按下标更新
+            N[path] += 1
+            W[path] += leaf_value * BACKUP_SIGNS[depth - 1::-1]
+            return
+        for node in reversed(path):
+            N[node] += 1
+            W[node] += leaf_value
+            leaf_value = -leaf_value
 
-    def select(self, c_puct):
+    def add_virtual_loss(self, path, virtual_loss):
         """
-        在子节点中选择能够提供最大的Q+U的节点
-        return: (action, next_node)的二元组
+        给路径上的节点加上虚拟损失：访问次数增加，价值按输棋计算，
+        让同一批次的其他搜索避开这条路径，传入负数时撤销
         """
-        return max(self._children.items(),
-                   key=lambda act_node: act_node[1].get_value(c_puct))
+        N, W = self.N, self.W
+        if len(path) > BACKUP_PYTHON_MAX_DEPTH:
+            N[path] += virtual_loss
+            W[path] -= virtual_loss
+            return
+        for node in path:
+            N[node] += virtual_loss
+            W[node] -= virtual_loss
+
+    def alias(self, node, other):
+        """让叶子节点node和已经展开的other指向同一个节点，共用同一组子节点，搜索树由此变成有向无环图"""
+        self.child[node] = self.child[other]
 
-    def get_value(self, c_puct):
+    def children(self, node):
+        """返回node所有子节点的动作和访问次数"""
+        start, end = self.edge_range(node)
+        return self.action[start:end].tolist(), self.N[start:end]
+
+    def find_child(self, node, action):
+        """返回node执行action之后的子节点，没有展开过时返回-1"""
+        start, end = self.edge_range(node)
+        index = np.flatnonzero(self.action[start:end] == action)
+        return start + int(index[0]) if len(index) else -1
+
+    def compact(self, root):
         """
-        计算并返回此节点的值，它是节点评估Q和此节点的先验的组合
-        c_puct: 控制相对影响（0， inf）
+        只保留以root为根的子树，按广度优先的顺序把它搬到数组的开头，root成为新的根节点0
+        每个节点的出边仍然连续存放，其余的边和节点全部释放，被多条边指向的节点只搬一次
+        return: 新下标i的边在原数组中的下标old[i]
         """
-        self._u = (c_puct * self._P *
-                   np.sqrt(self._parent._n_visits) / (1 + self._n_visits))
-        return self._Q + self._u
+        old = [root]            # 新下标i的边在原数组中的下标
+        child = [-1]
+        old_nodes = []          # 新下标j的节点在原数组中的下标
+        first_edge = []
+        moved = {}              # 原来的节点下标 --> 新的下标
+        i = 0
+        while i < len(old):
+            k = int(self.child[old[i]])
+            if k != -1:
+                if k in moved:
+                    child[i] = moved[k]
+                else:
+                    moved[k] = child[i] = len(old_nodes)
+                    old_nodes.append(k)
+                    first_edge.append(len(old))
+                    start = int(self.first_edge[k])
+                    n = int(self.n_edges[k])
+                    old.extend(range(start, start + n))
+                    child.extend([-1] * n)
+            i += 1
+        size = len(old)
+        for name in ('N', 'W', 'P', 'action'):
+            array = getattr(self, name)
+            array[:size] = array[old]
+        self.child[:size] = child
+        n_nodes = len(old_nodes)
+        self.n_edges[:n_nodes] = self.n_edges[old_nodes]
+        self.first_edge[:n_nodes] = first_edge
+        self.size = size
+        self.n_nodes = n_nodes
+        return old
 
-    def update(self, leaf_value):
+    def prune(self, target_size):
         """
-        从叶节点评估中更新节点值
-        leaf_value: 这个子节点的评估值来自当前玩家的视角
+        收起访问次数最少的子树，把边数减少到不超过target_size：按访问次数从多到少保留展开过的边，
+        保留下来的边加上它们的子节点的出边不超过target_size，其余展开过的边的child改回-1，
+        这些边的N和W保持不变，以后再搜索到时重新展开。子节点的访问次数少于父节点，保留的边总是连在根节点上
+        return: compact(0)的返回值，新下标i的边在原数组中的下标old[i]
         """
-        # 统计访问次数
-        self._n_visits += 1
-        # 更新Q值，取决于所有访问次数的平均树，使用增量式更新方式
-        self._Q += 1.0 * (leaf_value - self._Q) / self._n_visits
+        child = self.child[:self.size]
+        expanded = np.flatnonzero(child[1:] != -1) + 1
+        order = expanded[np.argsort(-self.N[expanded], kind='stable')]
+        start, end = self.edge_range(0)
+        cost = np.cumsum(self.n_edges[child[order]])
+        keep = int(np.searchsorted(cost, target_size - 1 - (end - start), side='right'))
+        self.child[order[keep:]] = -1
+        return self.compact(0)
 
-    # 使用递归的方法对所有节点（当前节点对应的支线）进行一次更新
-    def update_recursive(self, leaf_value):
-        """就像调用update()一样，但是对所有直系节点进行更新"""
-        # 如果它不是根节点，则应首先更新此节点的父节点
-        if self._parent:
-            self._parent.update_recursive(-leaf_value)
-        self.update(leaf_value)
 
-    def is_leaf(self):
-        """检查是否是叶节点，即没有被扩展的节点"""
-        return self._children == {}
+# 多线程搜索共用的网络评估队列
+class InferenceQueue(object):
+    """
+    搜索线程把叶子局面放进队列后等待结果，评估线程把同时到达的请求合并成一个批次送入网络
+    网络计算时不占用树锁，其他搜索线程可以继续在树上选择和更新
+    """
+
+    def __init__(self, policy_value_batch_fn, batch_size, timeout=0.002):
+        """
+        batch_size: 每批最多的请求数，一般等于搜索线程数
+        timeout: 收到第一个请求后最多再等多少秒凑满一批
+        """
+        self._policy_batch = policy_value_batch_fn
+        self._batch_size = batch_size
+        self._timeout = timeout
+        self._requests = queue.Queue()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def evaluate(self, board):
+        """评估一个局面，阻塞直到得到结果"""
+        request = [board, threading.Event(), None]
+        self._requests.put(request)
+        request[1].wait()
+        if isinstance(request[2], Exception):
+            raise request[2]
+        return request[2]
 
-    def is_root(self):
-        return self._parent is None
+    def _run(self):
+        closed = False
+        while not closed:
+            request = self._requests.get()
+            if request is None:
+                return
+            batch = [request]
+            while len(batch) < self._batch_size:
+                try:
+                    request = self._requests.get(timeout=self._timeout)
+                except queue.Empty:
+                    break
+                if request is None:
+                    closed = True
+                    break
+                batch.append(request)
+            try:
+                results = self._policy_batch([request[0] for request in batch])
+            except Exception as e:
+                results = [e] * len(batch)
+            for request, result in zip(batch, results):
+                request[2] = result
+                request[1].set()
+
+    def close(self):
+        self._requests.put(None)
+        self._thread.join()
 
 
 # 蒙特卡洛搜索树
 class MCTS(object):
 
-    def __init__(self, policy_value_fn, c_puct=5, n_playout=2000):
-        """policy_value_fn: 接收board的盘面状态，返回落子概率和盘面评估得分"""
-        self._root = TreeNode(None, 1.0)
+    def __init__(self, policy_value_fn, c_puct=5, n_playout=2000, select_mode='auto',
+                 policy_value_batch_fn=None, batch_size=1, n_threads=1, transposition_table_size=0,
+                 early_stop=False, memory_limit=0):
+        """
+        policy_value_fn: 接收board的盘面状态，返回落子概率和盘面评估得分
+        n_playout: 每次搜索默认的搜索次数上限，None表示不限次数，这时get_move_probs必须给出time_budget
+        select_mode: 子节点选择的计算方式，'numpy'、'python'或'auto'，见Tree.select
+        policy_value_batch_fn: 接收board的列表，返回每个board的落子概率和盘面评估得分，
+            给出这个函数并且batch_size大于1时，每次收集batch_size个叶子节点一起评估
+        n_threads: 大于1时用多个线程共同搜索一棵树，叶子节点通过InferenceQueue合并评估
+        transposition_table_size: 置换表的最大条目数，0表示不使用置换表
+        early_stop: 访问次数最多的走法已经不可能被超过时提前结束搜索，只有一个合法走法时不搜索
+        memory_limit: 搜索树最多占用的字节数，0表示不限制，快到上限时收起访问次数最少的子树，见Tree.prune
+            上限小于批量或多线程搜索一轮所需余量的4倍时按4倍余量计算
+        """
+        # 搜索树快满时每次搜索之间的余量：批量或多线程搜索时一轮最多展开这么多个节点
+        self._gc_headroom = MAX_EXPAND_EDGES * max(batch_size, n_threads, 1)
+        if memory_limit > 0:
+            # 容量至少是余量的4倍，整理后离快满还有至少一倍余量，不会每次搜索都整理
+            self._tree = Tree(max_capacity=max(Tree.capacity_for(memory_limit), 4 * self._gc_headroom))
+        else:
+            self._tree = Tree()
         self._policy = policy_value_fn
         self._c_puct = c_puct
         self._n_playout = n_playout
+        self._select_mode = select_mode
+        self._policy_batch = policy_value_batch_fn
+        self._batch_size = batch_size
+        self._virtual_loss = CONFIG['virtual_loss']
+        self._n_threads = n_threads
+        self._lock = threading.Lock()
+        self._n_started = 0
+        self._early_stop = early_stop
+        self._playout_limit = n_playout
+        self._deadline = None
+        self._start_time = 0
+        self._stopped_early = False
+        # 后台思考时由MCTSPlayer.stop_ponder设置，搜索看到后尽快停下
+        self._stop_event = None
+        # 多线程搜索时正在等待网络评估的路径数，为0时才能整理搜索树
+        self._n_in_flight = 0
+        # 多线程搜索时根节点的每条边上正在等待网络评估的路径数，判断能否提前结束时用来去掉虚拟损失
+        self._root_in_flight = {}
+        self._n_collections = 0
+        # 最近一次get_move_probs的统计：实际的搜索次数和耗时
+        self.stats = {}
+        # 置换表：局面 --> 已经展开的节点，不同走子顺序到达的同一局面共用子节点，不再重复调用网络
+        self._transposition_table = LRUCache(transposition_table_size) if transposition_table_size > 0 else None
 
-    def _playout(self, state):
+    def _select_leaf(self, state, first=None):
         """
-        进行一次搜索，根据叶节点的评估值进行反向更新树节点的参数
-        注意：state已就地修改，因此必须提供副本
+        从根节点一直选择到叶子节点，state跟着走子，返回经过的节点路径，最后一个是叶子节点
+        first: 根节点的一个子节点，给出时根节点不做选择直接走到first，Gumbel搜索用它指定根节点要搜索的走法
         """
-        node = self._root
-        while True:
-            if node.is_leaf():
-                break
+        tree = self._tree
+        node = 0
+        path = [0]
+        if first is not None:
+            state.do_move(int(tree.action[first]))
+            node = first
+            path.append(first)
+        while not tree.is_leaf(node):
             # 贪心算法选择下一步行动
-            action, node = node.select(self._c_puct)
+            action, node = tree.select(node, self._c_puct, self._select_mode)
             state.do_move(action)
+            path.append(node)
+        return path
+
+    def _transposition_key(self, state):
+        # 盘面哈希已经包含走子方，另外加上因为禁止重复而不能走的那一步和未吃子的回合数，它们也会影响后面的走法和胜负
+        # 只用真正被禁止的走法而不是key_history[-4]，否则不同走子顺序到达的同一局面几乎都不会相同
+        # 未吃子的回合数只增不减，吃子后棋子变少，所以同一条路径上不会出现相同的键，不会形成环
+        return state.zobrist_key, state.kill_action, state.banned_move()
+
+    def _transposition_lookup(self, node, state):
+        """
+        在置换表里查找叶子节点的局面，找到已经展开的同一局面时共用它的子节点，
+        返回它的平均价值作为叶子节点的值（当前走子方的视角），找不到时返回None
+        """
+        if self._transposition_table is None:
+            return None
+        tree = self._tree
+        other = self._transposition_table.get(self._transposition_key(state))
+        if other is None or other == node or tree.is_leaf(other) or tree.N[other] <= 0:
+            return None
+        tree.alias(node, other)
+        # other的价值是从走到它的一方来看的，和叶子节点的走子方相反
+        return -tree.W[other] / tree.N[other]
+
+    def _tree_full(self):
+        tree = self._tree
+        return tree.max_capacity is not None and tree.size > tree.max_capacity - self._gc_headroom
+
+    def _tree_stats(self, n_collections):
+        tree = self._tree
+        return {'tree_nodes': tree.n_nodes, 'tree_edges': len(tree), 'tree_bytes': tree.nbytes(),
+                'tree_collections': self._n_collections - n_collections}
+
+    def _remap_transpositions(self, old):
+        """搜索树整理之后，置换表里的节点下标跟着搬动，不在保留的子树里的条目丢弃"""
+        table = self._transposition_table
+        if table is None:
+            return
+        new_index = {node: i for i, node in enumerate(old)}
+        entries = table.items()
+        table.clear()
+        for key, node in entries:
+            if node in new_index:
+                table.put(key, new_index[node])
+
+    def _collect_garbage(self):
+        """
+        搜索树快要超过内存上限时，收起访问次数最少的子树，把边数减到上限的一半，
+        并且至少留出两倍余量，保证整理之后不会马上又满
+        只能在没有正在搜索的路径时调用，整理后所有节点的下标都会改变
+        """
+        max_capacity = self._tree.max_capacity
+        old = self._tree.prune(min(max_capacity // 2, max_capacity - 2 * self._gc_headroom))
+        self._remap_transpositions(old)
+        self._n_collections += 1
+
+    def _expand(self, node, state, action_probs):
+        self._tree.expand(node, action_probs)
+        if self._transposition_table is not None:
+            self._transposition_table.put(self._transposition_key(state), node)
+
+    def _playout(self, state, first=None):
+        """
+        进行一次搜索，根据叶节点的评估值进行反向更新树节点的参数，first见_select_leaf
+        注意：state会被就地修改，搜索结束前用undo_move恢复原状
+        """
+        path = self._select_leaf(state, first)
+        node = path[-1]
 
-        # 使用网络评估叶子节点，网络输出（动作，概率）元组p的列表以及当前玩家视角的得分[-1, 1]
-        action_probs, leaf_value = self._policy(state)
         # 查看游戏是否结束
         end, winner = state.game_end()
-        if not end:
-            node.expand(action_probs)
+        if end:
+            leaf_value = self._terminal_value(state, winner)
         else:
-            # 对于结束状态，将叶子节点的值换成1或-1
-            if winner == -1:    # Tie
-                leaf_value = 0.0
-            else:
-                leaf_value = (
-                    1.0 if winner == state.get_current_player_id() else -1.0
-                )
+            leaf_value = self._transposition_lookup(node, state)
+            if leaf_value is None:
+                # 使用网络评估叶子节点，网络输出（动作，概率）元组p的列表以及当前玩家视角的得分[-1, 1]
+                action_probs, leaf_value = self._policy(state)
+                # 网络返回的得分是形状为[1, 1]的数组，转换成浮点数
+                leaf_value = np.asarray(leaf_value).item()
+                self._expand(node, state, action_probs)
         # 在本次遍历中更新节点的值和访问次数
         # 必须添加符号，因为两个玩家共用一个搜索树
-        node.update_recursive(-leaf_value)
+        self._tree.update_path(path, -leaf_value)
+        # 沿着走过的路径撤销走子，把棋盘恢复到根节点的状态
+        for _ in range(len(path) - 1):
+            state.undo_move()
+
+    def _terminal_value(self, state, winner):
+        """对于结束状态，将叶子节点的值换成1或-1"""
+        if winner == -1:    # Tie
+            return 0.0
+        return 1.0 if winner == state.get_current_player_id() else -1.0
+
+    def _playout_batch(self, state, batch_size, firsts=None):
+        """
+        收集最多batch_size个叶子节点，一次性送入网络评估后再分别反向更新
+        已经选中的路径加上虚拟损失，使后面的搜索尽量走到别的叶子节点，
+        如果还是走到了同一批次中待评估的叶子节点，就停止收集，直接评估已收集的部分
+        firsts: 每次搜索在根节点指定走到的子节点，见_select_leaf
+        return: 本次完成的搜索次数，指定了firsts时完成的是它的前面这么多个
+        """
+        tree = self._tree
+        pending = []        # (路径, 叶子局面的快照)
+        pending_nodes = set()
+        n_done = 0
+        for i in range(batch_size):
+            path = self._select_leaf(state, firsts[i] if firsts is not None else None)
+            node = path[-1]
+            if node in pending_nodes:
+                for _ in range(len(path) - 1):
+                    state.undo_move()
+                break
+            end, winner = state.game_end()
+            # 结束状态和置换表中已有的局面不需要网络评估，立刻更新
+            leaf_value = self._terminal_value(state, winner) if end else self._transposition_lookup(node, state)
+            if leaf_value is not None:
+                tree.update_path(path, -leaf_value)
+                n_done += 1
+            else:
+                tree.add_virtual_loss(path, self._virtual_loss)
+                pending.append((path, state.copy()))
+                pending_nodes.add(node)
+            for _ in range(len(path) - 1):
+                state.undo_move()
+
+        if pending:
+            results = self._policy_batch([board for _, board in pending])
+            for (path, board), (action_probs, leaf_value) in zip(pending, results):
+                tree.add_virtual_loss(path, -self._virtual_loss)
+                self._expand(path[-1], board, action_probs)
+                tree.update_path(path, -np.asarray(leaf_value).item())
+        return n_done + len(pending)
+
+    def _search_thread(self, state, inference_queue, errors):
+        """
+        搜索线程：在自己的棋盘副本上反复执行搜索，直到所有线程一共开始了规定的次数或者超时
+        选择路径和反向更新时持有树锁，等待网络评估时释放
+        """
+        tree = self._tree
+        try:
+            while True:
+                with self._lock:
+                    if self._stopped_early or self._stop_requested() or self._n_started >= self._playout_limit or \
+                            (self._n_started > 0 and self._deadline is not None and time.perf_counter() >= self._deadline):
+                        return
+                    # 正在评估的路径还没有完成，算在剩余的搜索次数里
+                    if self._early_stop and self._n_started % EARLY_STOP_CHECK_INTERVAL == 0 and \
+                            self._lead_is_decisive(self._n_started - self._n_in_flight, self._playout_limit,
+                                                   self._start_time, self._deadline, self._root_in_flight):
+                        self._stopped_early = True
+                        return
+                    # 搜索树快满时要等其他线程手上的路径都更新完才能整理，这期间不开始新的搜索
+                    waiting = self._tree_full() and self._n_in_flight > 0
+                    if not waiting:
+                        if self._tree_full():
+                            self._collect_garbage()
+                        self._n_started += 1
+                        path = self._select_leaf(state)
+                        node = path[-1]
+                        end, winner = state.game_end()
+                        leaf_value = self._terminal_value(state, winner) if end else self._transposition_lookup(node, state)
+                        if leaf_value is not None:
+                            tree.update_path(path, -leaf_value)
+                        else:
+                            tree.add_virtual_loss(path, self._virtual_loss)
+                            self._n_in_flight += 1
+                            if len(path) > 1:
+                                self._root_in_flight[path[1]] = self._root_in_flight.get(path[1], 0) + 1
+                if waiting:
+                    time.sleep(0.0005)
+                    continue
+                if leaf_value is None:
+                    # 其他线程先评估了同一个叶子节点时，expand不会重复展开，只更新访问次数和价值
+                    action_probs = None
+                    try:
+                        action_probs, leaf_value = inference_queue.evaluate(state)
+                    finally:
+                        # 评估出错时也要撤销虚拟损失，减少待评估的路径数，否则等着整理搜索树的线程会一直等下去
+                        with self._lock:
+                            tree.add_virtual_loss(path, -self._virtual_loss)
+                            self._n_in_flight -= 1
+                            if len(path) > 1:
+                                self._root_in_flight[path[1]] -= 1
+                                # 整理搜索树时没有正在评估的路径，表里不留下标会改变的空条目
+                                if self._root_in_flight[path[1]] == 0:
+                                    del self._root_in_flight[path[1]]
+                            if action_probs is not None:
+                                self._expand(node, state, action_probs)
+                                tree.update_path(path, -np.asarray(leaf_value).item())
+                for _ in range(len(path) - 1):
+                    state.undo_move()
+        except Exception as e:
+            errors.append(e)
+
+    def _search_parallel(self, state, n_playout, deadline):
+        """
+        用n_threads个线程共同完成n_playout次搜索或者一直搜索到deadline，每个线程使用自己的棋盘副本
+        return: 实际完成的搜索次数
+        """
+        if self._policy_batch is not None:
+            policy_batch = self._policy_batch
+        else:
+            policy_batch = lambda boards: [self._policy(board) for board in boards]
+        inference_queue = InferenceQueue(policy_batch, self._n_threads)
+        errors = []
+        self._n_started = 0
+        self._root_in_flight = {}
+        self._playout_limit = n_playout
+        self._deadline = deadline
+        self._start_time = time.perf_counter()
+        self._stopped_early = False
+        threads = [threading.Thread(target=self._search_thread, args=(state.copy(), inference_queue, errors))
+                   for _ in range(self._n_threads)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        inference_queue.close()
+        if errors:
+            raise errors[0]
+        return self._n_started
+
+    def add_root_noise(self, state, epsilon, alpha, rng):
+        """
+        给根节点子节点的先验概率混入Dirichlet噪声，P = (1 - epsilon) * P + epsilon * Dir(alpha)
+        根节点还没有展开时先执行一次搜索把它展开
+        rng: numpy的随机数生成器，不同的种子得到不同的噪声
+        """
+        tree = self._tree
+        if tree.is_leaf(0):
+            self._playout(state)
+        start, end = tree.edge_range(0)
+        if end > start:
+            noise = rng.dirichlet(alpha * np.ones(end - start))
+            tree.P[start:end] = (1 - epsilon) * tree.P[start:end] + epsilon * noise
+
+    def _stop_requested(self):
+        return self._stop_event is not None and self._stop_event.is_set()
 
-    def get_move_probs(self, state, temp=1e-3):
+    def _remaining_playouts(self, n, n_playout, start_time, deadline):
+        """估计还能进行的搜索次数，限时搜索时按目前的搜索速度估计"""
+        remaining = n_playout - n
+        if deadline is not None and n > 0:
+            now = time.perf_counter()
+            remaining = min(remaining, n / max(now - start_time, 1e-9) * max(deadline - now, 0))
+        return remaining
+
+    def _lead_is_decisive(self, n, n_playout, start_time, deadline, root_in_flight=None):
+        """
+        根节点访问次数最多的子节点领先第二名超过剩余的搜索次数时，选出的走法已经不会改变
+        n: 已经完成的搜索次数
+        root_in_flight: 多线程搜索时根节点每条边上正在评估的路径数，比较前从访问次数中去掉它们的虚拟损失
+        """
+        tree = self._tree
+        start, end = tree.edge_range(0)
+        n_children = end - start
+        if n_children < 2:
+            return False
+        visits = tree.N[start:end]
+        if root_in_flight:
+            visits = visits.copy()
+            for edge, count in root_in_flight.items():
+                visits[edge - start] -= self._virtual_loss * count
+        second, first = np.partition(visits, n_children - 2)[n_children - 2:]
+        return first - second > self._remaining_playouts(n, n_playout, start_time, deadline)
+
+    def get_move_probs(self, state, temp=1e-3, time_budget=None, n_playout=None):
         """
         按顺序运行所有搜索并返回可用的动作及其相应的概率
         state:当前游戏的状态
         temp:介于（0， 1]之间的温度参数
+        time_budget:本次搜索最多使用的秒数，None表示不限时
+        n_playout:本次搜索最多的搜索次数，None时使用构造时给的n_playout，构造时也是None时不限次数，只按time_budget限制
+        时间和次数都给出时哪个先用完就停止，至少完成一次搜索
+        开启early_stop时，只有一个合法走法直接返回，最好的走法已经不会改变时提前停止，
+        省下的搜索次数记录在stats['playouts_saved']中，限时搜索时按搜索速度估计
+        stats中还有搜索树展开过的节点数tree_nodes、边数tree_edges、占用的字节数tree_bytes
+        和这次搜索中因为内存上限整理搜索树的次数tree_collections
+        搜索被stop_event停下时可能一次都没有完成，根节点还没有展开时返回空的走法列表
         """
-        for n in range(self._n_playout):
-            state_copy = copy.deepcopy(state)
-            self._playout(state_copy)
+        if n_playout is None:
+            n_playout = self._n_playout if self._n_playout is not None else math.inf
+        start_time = time.perf_counter()
+        deadline = None if time_budget is None else start_time + time_budget
+        n_collections = self._n_collections
+        if self._early_stop and len(state.availables) == 1:
+            # 只有一步可走，不需要搜索
+            saved = self._remaining_playouts(0, n_playout, start_time, deadline)
+            self.stats = {'playouts': 0, 'seconds': time.perf_counter() - start_time,
+                          'playouts_saved': int(saved) if saved != math.inf else 0}
+            self.stats.update(self._tree_stats(n_collections))
+            return list(state.availables), np.ones(1)
+
+        stopped_early = False
+        if self._n_threads > 1:
+            n = self._search_parallel(state, n_playout, deadline)
+            stopped_early = self._stopped_early
+        else:
+            batched = self._policy_batch is not None and self._batch_size > 1
+            n = 0
+            next_check = EARLY_STOP_CHECK_INTERVAL
+            while n < n_playout and not self._stop_requested() and \
+                    (n == 0 or deadline is None or time.perf_counter() < deadline):
+                if self._tree_full():
+                    self._collect_garbage()
+                if batched:
+                    n += self._playout_batch(state, min(self._batch_size, n_playout - n))
+                else:
+                    self._playout(state)
+                    n += 1
+                if self._early_stop and n >= next_check:
+                    next_check = n + EARLY_STOP_CHECK_INTERVAL
+                    if self._lead_is_decisive(n, n_playout, start_time, deadline):
+                        stopped_early = True
+                        break
+        self.stats = {'playouts': n, 'seconds': time.perf_counter() - start_time,
+                      'playouts_saved': int(self._remaining_playouts(n, n_playout, start_time, deadline))
+                      if stopped_early else 0}
+        self.stats.update(self._tree_stats(n_collections))
 
+        # 后台思考在第一次搜索之前就被停下时根节点还没有展开，没有可以返回的走法
+        if self._tree.is_leaf(0):
+            return [], np.zeros(0)
         # 跟据根节点处的访问计数来计算移动概率
-        act_visits= [(act, node._n_visits)
-                     for act, node in self._root._children.items()]
-        acts, visits = zip(*act_visits)
-        act_probs = softmax(1.0 / temp * np.log(np.array(visits) + 1e-10))
+        acts, visits = self._tree.children(0)
+        act_probs = softmax(1.0 / temp * np.log(visits + 1e-10))
         return acts, act_probs
 
+    def ponder(self, state, stop_event, max_playouts):
+        """
+        轮到对方走子时在后台线程里继续搜索state，直到stop_event被设置或者搜索了max_playouts次
+        搜索结果留在树上，对方走子后沿这一步前进就能保留对应的子树，所以这里不提前结束搜索
+        """
+        early_stop, self._early_stop = self._early_stop, False
+        self._stop_event = stop_event
+        try:
+            self.get_move_probs(state, n_playout=max_playouts)
+        finally:
+            self._early_stop = early_stop
+            self._stop_event = None
+
+    def _search_children(self, state, children):
+        """依次从根节点的第children[i]个子节点往下搜索一次，批量评估时每批收集batch_size个"""
+        batched = self._policy_batch is not None and self._batch_size > 1
+        i = 0
+        while i < len(children):
+            if self._tree_full():
+                self._collect_garbage()
+            # 整理搜索树不会改变根节点子节点的顺序，只会改变它们的下标
+            offset = self._tree.edge_range(0)[0]
+            if batched:
+                batch = [offset + child for child in children[i:i + self._batch_size]]
+                i += self._playout_batch(state, len(batch), batch)
+            else:
+                self._playout(state, offset + children[i])
+                i += 1
+
+    def _sigma(self, q, visits):
+        """把[-1, 1]的价值归一化到[0, 1]后按访问次数放大，和先验的logits相加"""
+        return (GUMBEL_C_VISIT + visits.max()) * GUMBEL_C_SCALE * (q + 1) / 2
+
+    def get_move_gumbel(self, state, n_playout=None, k=16, rng=None):
+        """
+        Gumbel搜索：根节点用Gumbel top-k采样加顺序减半（sequential halving）分配搜索次数，根节点以下仍然用PUCT，
+        搜索次数只有几十到几百次时也能保证改进策略，适合自我对弈
+        先按 g + logits 选出k个候选走法，g是Gumbel噪声，rng为None时不加噪声；
+        每一轮给剩下的候选平均分配这一轮的搜索次数，再按 g + logits + sigma(q) 淘汰一半，最后剩下的就是选中的走法
+        候选数不超过搜索次数，剩下的次数不够每个候选搜索一次时停止淘汰，取分数最高的候选，总的搜索次数不超过n_playout
+        只按n_playout限制，不限时，也不提前结束，批量评估时每批按batch_size收集，不使用多线程
+        return: (选中的走法, 根节点的所有走法, 改进后的策略)，改进后的策略是 softmax(logits + sigma(completed_q))，
+            访问过的走法用它的平均价值，没有访问过的用根节点价值和访问过的走法按先验加权的平均价值，作为训练目标
+        """
+        if n_playout is None:
+            n_playout = self._n_playout
+        start_time = time.perf_counter()
+        n_collections = self._n_collections
+        tree = self._tree
+        n = 0
+        if tree.is_leaf(0):
+            self._playout(state)
+            n += 1
+        # W[0]是从对方的视角计算的
+        root_value = -tree.W[0] / tree.N[0]
+        start, end = tree.edge_range(0)
+        acts = tree.action[start:end].tolist()
+        logits = np.log(tree.P[start:end].astype(np.float64) + 1e-12)
+        g = rng.gumbel(size=end - start) if rng is not None else np.zeros(end - start)
+        candidates = np.argsort(-(g + logits), kind='stable')[:max(1, min(k, end - start, n_playout - n))]
+
+        def ranked(candidates):
+            start, end = tree.edge_range(0)
+            visits = tree.N[start:end]
+            q = tree.W[start:end] / np.maximum(visits, 1)
+            score = (g + logits + self._sigma(q, visits))[candidates]
+            return candidates[np.argsort(-score, kind='stable')]
+
+        while len(candidates) > 1 and n_playout - n >= len(candidates):
+            n_phases = int(math.ceil(math.log2(len(candidates))))
+            per_child = max(1, (n_playout - n) // (n_phases * len(candidates)))
+            # 轮流搜索各个候选，批量评估时同一批里尽量是不同的子节点
+            self._search_children(state, [int(c) for _ in range(per_child) for c in candidates])
+            n += per_child * len(candidates)
+            candidates = ranked(candidates)[:(len(candidates) + 1) // 2]
+        candidates = ranked(candidates)
+
+        start, end = tree.edge_range(0)
+        visits = tree.N[start:end]
+        q = tree.W[start:end] / np.maximum(visits, 1)
+        prior = softmax(logits)
+        visited = visits > 0
+        if visited.any():
+            mixed_value = (root_value + visits.sum() * np.dot(prior[visited], q[visited]) / prior[visited].sum()) / \
+                (1 + visits.sum())
+        else:
+            mixed_value = root_value
+        completed_q = np.where(visited, q, mixed_value)
+        improved_policy = softmax(logits + self._sigma(completed_q, visits))
+        self.stats = {'playouts': n, 'seconds': time.perf_counter() - start_time, 'playouts_saved': 0}
+        self.stats.update(self._tree_stats(n_collections))
+        return acts[int(candidates[0])], acts, improved_policy
+
     def update_with_move(self, last_move):
         """
         在当前的树上向前一步，保持我们已经直到的关于子树的一切
         """
-        if last_move in self._root._children:
-            self._root = self._root._children[last_move]
-            self._root._parent = None
+        child = self._tree.find_child(0, last_move)
+        if child != -1:
+            # 只搬动保留下来的子树，丢弃的节点不需要逐个释放，花费和保留的节点数成正比
+            self._remap_transpositions(self._tree.compact(child))
         else:
-            self._root = TreeNode(None, 1.0)
+            self._tree.reset()
+            if self._transposition_table is not None:
+                self._transposition_table.clear()
 
     def __str__(self):
         return 'MCTS'
 
 
+# 根并行搜索工作进程中的网络，由进程池的initializer创建，每个进程一个
+_worker_net = None
+
+
+def _init_root_worker(policy_factory):
+    global _worker_net
+    _worker_net = policy_factory()
+
+
+def _root_search(board, c_puct, n_playout, seed, time_budget=None, memory_limit=0):
+    """
+    在工作进程中从board独立搜索n_playout次或time_budget秒，根节点加入按seed生成的噪声
+    return: 根节点的动作、访问次数和实际的搜索次数
+    """
+    start_time = time.perf_counter()
+    np.random.seed(seed)
+    mcts = MCTS(_worker_net.policy_value_fn, c_puct, n_playout - 1, memory_limit=memory_limit)
+    mcts.add_root_noise(board, 0.25, CONFIG['dirichlet'], np.random.default_rng(seed))
+    if time_budget is not None:
+        time_budget = max(time_budget - (time.perf_counter() - start_time), 0)
+    mcts.get_move_probs(board, time_budget=time_budget, n_playout=n_playout - 1)
+    acts, visits = mcts._tree.children(0)
+    return acts, visits, mcts.stats['playouts'] + 1
+
+
 # 基于MCTS的AI玩家
 class MCTSPlayer(object):
 
-    def __init__(self, policy_value_function, c_puct=5, n_playout=2000, is_selfplay=0):
-        self.mcts = MCTS(policy_value_function, c_puct, n_playout)
+    def __init__(self, policy_value_function, c_puct=5, n_playout=2000, is_selfplay=0, select_mode='auto',
+                 policy_value_batch_function=None, batch_size=1, n_threads=1,
+                 n_processes=1, policy_factory=None, transposition_table_size=0, time_budget=None,
+                 early_stop=None, ponder_playouts=None, memory_limit=0, root_policy='puct', gumbel_k=16):
+        """
+        n_processes: 大于1时使用根并行，n_processes个进程各自独立搜索n_playout/n_processes次，
+            根节点使用不同的噪声种子，最后把根节点的访问次数相加
+        policy_factory: 根并行时在每个工作进程中创建网络的可pickle的无参函数，返回的对象要有policy_value_fn方法，
+            比如functools.partial(PolicyValueNet, model_file='current_policy.pkl')，n_processes大于1时必须给出
+        n_playout: 每步默认的搜索次数，None表示只按time_budget限制，这时必须给出time_budget，也不能使用'gumbel'
+        time_budget: 每步默认的思考时间（秒），None表示只按n_playout限制，两者都给出时哪个先用完就停止，见get_action
+        early_stop: 是否在结果已经确定时提前结束搜索，默认只在非自我对弈时开启，
+            自我对弈的训练目标是访问次数的分布，提前结束会改变它；根并行搜索不会提前结束
+        ponder_playouts: 后台思考（见start_ponder）最多搜索的次数，限制对方长时间思考时搜索树的大小，
+            默认为n_playout的10倍，n_playout为None时是CONFIG['play_out']的10倍
+        memory_limit: 搜索树最多占用的字节数，0表示不限制，见MCTS
+        root_policy: 根节点的搜索方式，'puct'按访问次数的分布选择走法和生成训练目标，
+            'gumbel'使用Gumbel top-k采样加顺序减半（见MCTS.get_move_gumbel），训练目标是改进后的策略，
+            自我对弈时只加Gumbel噪声而不加Dirichlet噪声，只按搜索次数限制，不使用time_budget，也不提前结束；
+            根并行搜索时仍然使用'puct'
+        gumbel_k: Gumbel搜索在根节点考虑的候选走法数
+        """
+        if n_playout is None and (time_budget is None or root_policy == 'gumbel'):
+            raise ValueError("n_playout can only be None when time_budget is given and root_policy is 'puct'")
+        if n_processes > 1 and policy_factory is None:
+            raise ValueError('policy_factory is required when n_processes > 1')
+        if early_stop is None:
+            early_stop = not is_selfplay
+        self.mcts = MCTS(policy_value_function, c_puct, n_playout, select_mode,
+                         policy_value_batch_function, batch_size, n_threads, transposition_table_size,
+                         early_stop, memory_limit)
         self._is_selfplay = is_selfplay
+        self._c_puct = c_puct
+        self._n_playout = n_playout
+        self._time_budget = time_budget
+        self._memory_limit = memory_limit
+        self._root_policy = root_policy
+        self._gumbel_k = gumbel_k
+        self._n_processes = n_processes
+        self._policy_factory = policy_factory
+        self._pool = None
+        # 非自我对弈时搜索树的根停在我们走子后的局面，记录这个局面的(步数, 盘面哈希)，下一步时核对对方的走子
+        self._tree_position = None
+        if ponder_playouts is None:
+            ponder_playouts = 10 * (n_playout if n_playout is not None else CONFIG['play_out'])
+        self._ponder_playouts = ponder_playouts
+        self._ponder_thread = None
+        self._ponder_stop = None
+        self._ponder_errors = []
+        # 最近一步的搜索统计
+        self.stats = {}
         self.agent = "AI"
 
+    def _get_move_probs_root_parallel(self, board, temp, time_budget, n_playout):
+        """根并行搜索，返回合并后的动作和概率"""
+        start_time = time.perf_counter()
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(max_workers=self._n_processes,
+                                             initializer=_init_root_worker,
+                                             initargs=(self._policy_factory,))
+        if n_playout is None:
+            n_playout = self._n_playout
+        if n_playout is None:
+            n_playout = math.inf    # 只按时间限制
+        else:
+            n_playout = max(n_playout // self._n_processes, 2)
+        seeds = np.random.randint(2 ** 31, size=self._n_processes)
+        futures = [self._pool.submit(_root_search, board, self._c_puct, n_playout, int(seed), time_budget,
+                                     self._memory_limit)
+                   for seed in seeds]
+        visits = np.zeros(2086)
+        playouts = 0
+        for future in futures:
+            acts, act_visits, n = future.result()
+            visits[acts] += act_visits
+            playouts += n
+        acts = np.flatnonzero(visits).tolist()
+        act_probs = softmax(1.0 / temp * np.log(visits[acts] + 1e-10))
+        self.mcts.stats = {'playouts': playouts, 'seconds': time.perf_counter() - start_time, 'playouts_saved': 0}
+        return acts, act_probs
+
+    def start_ponder(self, board):
+        """
+        轮到对方走子时在后台线程里继续搜索board（对方走子前的局面），不阻塞调用者，
+        对方走子后调用get_action时停止后台搜索，并沿对方的走子保留搜索过的子树
+        自我对弈、根并行搜索或者棋局已经结束时不做任何事
+        """
+        if self._is_selfplay or self._n_processes > 1 or self._ponder_thread is not None or board.game_end()[0]:
+            return
+        position = (len(board.move_stack), board.zobrist_key)
+        if self._tree_position != position:
+            # 搜索树不是这个局面的（比如对方先走或者开始了新的一局），从这个局面重新开始
+            self.mcts.update_with_move(-1)
+            self._tree_position = position
+        self._ponder_stop = threading.Event()
+        self._ponder_thread = threading.Thread(target=self._ponder, args=(board.copy(), self._ponder_stop), daemon=True)
+        self._ponder_thread.start()
+
+    def _ponder(self, board, stop_event):
+        try:
+            self.mcts.ponder(board, stop_event, self._ponder_playouts)
+        except Exception as e:
+            self._ponder_errors.append(e)
+
+    def stop_ponder(self):
+        """停止后台思考并等待搜索线程退出，返回后台搜索的次数"""
+        if self._ponder_thread is None:
+            return 0
+        self._ponder_stop.set()
+        self._ponder_thread.join()
+        self._ponder_thread = None
+        if self._ponder_errors:
+            raise self._ponder_errors.pop()
+        return self.mcts.stats.get('playouts', 0)
+
+    # 关闭根并行的进程池
+    def close(self):
+        self.stop_ponder()
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+
     def set_player_ind(self, p):
         self.player = p
 
     # 重置搜索树
     def reset_player(self):
+        self.stop_ponder()
         self.mcts.update_with_move(-1)
+        self._tree_position = None
+
+    def _advance_tree(self, board):
+        """
+        非自我对弈时沿对方刚走的一步把搜索树的根前进到当前局面，保留这一步下面已经搜索过的子树，
+        board不是从我们上次走子后的局面走了一步得到的（比如开始了新的一局）时清空搜索树
+        """
+        if self._tree_position is None:
+            return
+        ply, key = self._tree_position
+        self._tree_position = None
+        if len(board.move_stack) == ply + 1 and board.key_history[-2] == key:
+            self.mcts.update_with_move(board.last_move)
+        else:
+            self.mcts.update_with_move(-1)
 
     def __str__(self):
         return 'MCTS {}'.format(self.player)
 
     # 得到行动
-    def get_action(self, board, temp=1e-3, return_prob=0):
-        # 像alphaGo_Zero论文一样使用MCTS算法返回的pi向量
+    # time_budget和n_playout限制这一步的思考时间（秒）和搜索次数，不给出时使用构造时的设置，
+    # root_policy为'gumbel'时只用n_playout，time_budget不起作用
+    # 实际的搜索次数和耗时记录在self.stats中，reused_nodes、reused_edges和reused_visits是从上一步保留下来的
+    # 展开过的节点数、边数和根节点访问次数，
+    # ponder_playouts是对方思考时后台搜索的次数
+    def get_action(self, board, temp=1e-3, return_prob=0, time_budget=None, n_playout=None):
+        ponder_playouts = self.stop_ponder()
+        # 像alphaGo_Zero论文一样使用MCTS算法返回的pi向量，Gumbel搜索时是改进后的策略
         move_probs = np.zeros(2086)
+        if time_budget is None:
+            time_budget = self._time_budget
 
-        acts, probs = self.mcts.get_move_probs(board, temp)
+        move = None
+        if self._n_processes > 1:
+            acts, probs = self._get_move_probs_root_parallel(board, temp, time_budget, n_playout)
+            reused_nodes = reused_edges = reused_visits = 0
+        else:
+            self._advance_tree(board)
+            tree = self.mcts._tree
+            reused_visits = int(tree.N[0])
+            reused_nodes = tree.n_nodes if reused_visits else 0
+            reused_edges = len(tree) if reused_visits else 0
+            if self._root_policy == 'gumbel':
+                # 搜索已经按Gumbel噪声选好了走法，不需要再按概率抽样
+                move, acts, probs = self.mcts.get_move_gumbel(board, n_playout, self._gumbel_k,
+                                                              np.random if self._is_selfplay else None)
+            else:
+                acts, probs = self.mcts.get_move_probs(board, temp, time_budget, n_playout)
+        self.stats = dict(self.mcts.stats, reused_nodes=reused_nodes, reused_edges=reused_edges,
+                          reused_visits=reused_visits, ponder_playouts=ponder_playouts)
         move_probs[list(acts)] = probs
         if self._is_selfplay:
-            # 添加Dirichlet Noise进行探索（自我对弈需要）
-            move = np.random.choice(
-                acts,
-                p=0.75*probs + 0.25*np.random.dirichlet(CONFIG['dirichlet'] * np.ones(len(probs)))
-            )
+            if move is None:
+                # 添加Dirichlet Noise进行探索（自我对弈需要）
+                move = np.random.choice(
+                    acts,
+                    p=0.75*probs + 0.25*np.random.dirichlet(CONFIG['dirichlet'] * np.ones(len(probs)))
+                )
             # 更新根节点并重用搜索树
             self.mcts.update_with_move(move)
         else:
-            # 使用默认的temp=1e-3，它几乎相当于选择具有最高概率的移动
-            move = np.random.choice(acts, p=probs)
-            # 重置根节点
-            self.mcts.update_with_move(-1)
+            if move is None:
+                # 使用默认的temp=1e-3，它几乎相当于选择具有最高概率的移动
+                move = np.random.choice(acts, p=probs)
+            if self._n_processes > 1:
+                # 根并行时每个进程各自建树，没有可以保留的搜索树
+                self.mcts.update_with_move(-1)
+            else:
+                # 保留我们这一步下面的子树，等下一次轮到我们时再沿对方的走子前进
+                self.mcts.update_with_move(move)
+                board.do_move(move)
+                self._tree_position = (len(board.move_stack), board.zobrist_key)
+                board.undo_move()
         if return_prob:
             return move, move_probs
         else:
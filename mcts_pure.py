@@ -5,11 +5,16 @@ A pure implementation of the Monte Carlo Tree Search (MCTS)
 @author: Junxiao Song
 """
 
+import math
 import numpy as np
-import copy
 from operator import itemgetter
 
 
+# With select_mode='auto', nodes with at most this many children are scored
+# in pure Python; wider nodes are scored with one NumPy expression.
+SELECT_PYTHON_MAX_CHILDREN = 32
+
+
 def rollout_policy_fn(board):
     """a coarse, fast version of policy_fn used in the rollout phase."""
     # rollout randomly
@@ -28,32 +33,64 @@ def policy_value_fn(board):
 class TreeNode(object):
     """A node in the MCTS tree. Each node keeps track of its own value Q,
     prior probability P, and its visit-count-adjusted prior score u.
+    The children are kept as arrays of actions, priors, visit counts and Q
+    values; a child TreeNode is only created when selection first picks it.
     """
 
-    def __init__(self, parent, prior_p):
+    def __init__(self, parent, prior_p, index=0):
         self._parent = parent
-        self._children = {}  # a map from action to TreeNode
+        self._children = {}  # a map from child index to TreeNode, filled lazily
         self._n_visits = 0
         self._Q = 0
-        self._u = 0
         self._P = prior_p
+        # position of this node in its parent's child arrays
+        self._index = index
+        # legal actions with their N, Q and P, None until expanded
+        self._child_actions = None
+        self._child_N = None
+        self._child_Q = None
+        self._child_P = None
 
     def expand(self, action_priors):
-        """Expand tree by creating new children.
+        """Expand tree by recording the legal actions and their priors.
         action_priors: a list of tuples of actions and their prior probability
             according to the policy function.
         """
-        for action, prob in action_priors:
-            if action not in self._children:
-                self._children[action] = TreeNode(self, prob)
-
-    def select(self, c_puct):
+        action_priors = list(action_priors)
+        if self._child_actions is not None or not action_priors:
+            return
+        actions, priors = zip(*action_priors)
+        self._child_actions = list(actions)
+        self._child_N = np.zeros(len(actions), dtype=np.float64)
+        self._child_Q = np.zeros(len(actions), dtype=np.float64)
+        self._child_P = np.array(priors, dtype=np.float64)
+
+    def child(self, index):
+        """Return the child at the given position, creating it on first use."""
+        node = self._children.get(index)
+        if node is None:
+            node = self._children[index] = TreeNode(self, self._child_P[index], index)
+        return node
+
+    def select(self, c_puct, select_mode='auto'):
         """Select action among children that gives maximum action value Q
         plus bonus u(P).
+        select_mode: 'numpy' scores all children in one array expression,
+            'python' scores them one by one, 'auto' picks by branching factor.
+        Unvisited children have N = Q = 0 and are scored by their prior alone.
         Return: A tuple of (action, next_node)
         """
-        return max(self._children.items(),
-                   key=lambda act_node: act_node[1].get_value(c_puct))
+        sqrt_n = math.sqrt(self._n_visits)
+        if select_mode == 'numpy' or (select_mode == 'auto' and
+                                      len(self._child_actions) > SELECT_PYTHON_MAX_CHILDREN):
+            score = self._child_Q + c_puct * self._child_P * sqrt_n / (1 + self._child_N)
+            index = int(score.argmax())
+        else:
+            n = self._child_N.tolist()
+            q = self._child_Q.tolist()
+            p = self._child_P.tolist()
+            index = max(range(len(n)), key=lambda i: q[i] + c_puct * p[i] * sqrt_n / (1 + n[i]))
+        return self._child_actions[index], self.child(index)
 
     def update(self, leaf_value):
         """Update node values from leaf evaluation.
@@ -64,30 +101,14 @@ class TreeNode(object):
         self._n_visits += 1
         # Update Q, a running average of values for all visits.
         self._Q += 1.0*(leaf_value - self._Q) / self._n_visits
-
-    def update_recursive(self, leaf_value):
-        """Like a call to update(), but applied recursively for all ancestors.
-        """
-        # If it is not root, this node's parent should be updated first.
-        if self._parent:
-            self._parent.update_recursive(-leaf_value)
-        self.update(leaf_value)
-
-    def get_value(self, c_puct):
-        """Calculate and return the value for this node.
-        It is a combination of leaf evaluations Q, and this node's prior
-        adjusted for its visit count, u.
-        c_puct: a number in (0, inf) controlling the relative impact of
-            value Q, and prior probability P, on this node's score.
-        """
-        self._u = (c_puct * self._P *
-                   np.sqrt(self._parent._n_visits) / (1 + self._n_visits))
-        return self._Q + self._u
+        if self._parent is not None:
+            self._parent._child_N[self._index] = self._n_visits
+            self._parent._child_Q[self._index] = self._Q
 
     def is_leaf(self):
         """Check if leaf node (i.e. no nodes below this have been expanded).
         """
-        return self._children == {}
+        return self._child_actions is None
 
     def is_root(self):
         return self._parent is None
@@ -96,7 +117,7 @@ class TreeNode(object):
 class MCTS(object):
     """A simple implementation of Monte Carlo Tree Search."""
 
-    def __init__(self, policy_value_fn, c_puct=5, n_playout=10000):
+    def __init__(self, policy_value_fn, c_puct=5, n_playout=10000, select_mode='auto'):
         """
         policy_value_fn: a function that takes in a board state and outputs
             a list of (action, probability) tuples and also a score in [-1, 1]
@@ -105,25 +126,31 @@ class MCTS(object):
         c_puct: a number in (0, inf) that controls how quickly exploration
             converges to the maximum-value policy. A higher value means
             relying on the prior more.
+        select_mode: how children are scored during selection, 'numpy',
+            'python' or 'auto' (see TreeNode.select).
         """
         self._root = TreeNode(None, 1.0)
         self._policy = policy_value_fn
         self._c_puct = c_puct
         self._n_playout = n_playout
+        self._select_mode = select_mode
 
     def _playout(self, state):
         """Run a single playout from the root to the leaf, getting a value at
         the leaf and propagating it back through its parents.
-        State is modified in-place, so a copy must be provided.
+        State is modified in-place and restored with undo_move() before
+        returning, so the caller's board can be passed directly.
         """
         node = self._root
+        path = [node]
         while(1):
             if node.is_leaf():
 
                 break
             # Greedily select next move.
-            action, node = node.select(self._c_puct)
+            action, node = node.select(self._c_puct, self._select_mode)
             state.do_move(action)
+            path.append(node)
 
         action_probs, _ = self._policy(state)
         # Check for end of game
@@ -132,15 +159,24 @@ class MCTS(object):
             node.expand(action_probs)
         # Evaluate the leaf node by random rollout
         leaf_value = self._evaluate_rollout(state)
-        # Update value and visit count of nodes in this traversal.
-        node.update_recursive(-leaf_value)
+        # Update value and visit count of nodes in this traversal,
+        # walking the recorded path from the leaf back to the root.
+        leaf_value = -leaf_value
+        for node in reversed(path):
+            node.update(leaf_value)
+            leaf_value = -leaf_value
+        # Unwind the moves of the selection phase.
+        for _ in range(len(path) - 1):
+            state.undo_move()
 
     def _evaluate_rollout(self, state, limit=1000):
         """Use the rollout policy to play until the end of the game,
         returning +1 if the current player wins, -1 if the opponent wins,
         and 0 if it is a tie.
+        The rollout moves are undone before returning.
         """
         player = state.get_current_player_id()
+        n_moves = 0
         for i in range(limit):
             end, winner = state.game_end()
             if end:
@@ -148,9 +184,12 @@ class MCTS(object):
             action_probs = rollout_policy_fn(state)
             max_action = max(action_probs, key=itemgetter(1))[0]
             state.do_move(max_action)
+            n_moves += 1
         else:
             # If no break from the loop, issue a warning.
             print("WARNING: rollout reached move limit")
+        for _ in range(n_moves):
+            state.undo_move()
         if winner == -1:  # tie
             return 0
         else:
@@ -163,17 +202,17 @@ class MCTS(object):
         Return: the selected action
         """
         for n in range(self._n_playout):
-            state_copy = copy.deepcopy(state)
-            self._playout(state_copy)
-        return max(self._root._children.items(),
-                   key=lambda act_node: act_node[1]._n_visits)[0]
+            self._playout(state)
+        root = self._root
+        return root._child_actions[int(root._child_N.argmax())]
 
     def update_with_move(self, last_move):
         """Step forward in the tree, keeping everything we already know
         about the subtree.
         """
-        if last_move in self._root._children:
-            self._root = self._root._children[last_move]
+        root = self._root
+        if root._child_actions is not None and last_move in root._child_actions:
+            self._root = root.child(root._child_actions.index(last_move))
             self._root._parent = None
         else:
             self._root = TreeNode(None, 1.0)
@@ -184,8 +223,8 @@ class MCTS(object):
 
 class MCTS_Pure(object):
     """AI player based on MCTS"""
-    def __init__(self, c_puct=5, n_playout=2000):
-        self.mcts = MCTS(policy_value_fn, c_puct, n_playout)
+    def __init__(self, c_puct=5, n_playout=2000, select_mode='auto'):
+        self.mcts = MCTS(policy_value_fn, c_puct, n_playout, select_mode)
 
     def set_player_ind(self, p):
         self.player = p
@@ -5,6 +5,9 @@ import paddle
 import paddle.nn as nn
 import numpy as np
 import paddle.nn.functional as F
+from config import CONFIG
+from game import get_state_batch
+from cache import LRUCache
 
 
 # 搭建残差块
@@ -101,9 +104,16 @@ class PolicyValueNet:
         self.optimizer = paddle.optimizer.Adam(learning_rate=0.001,
                                                parameters=self.policy_value_net.parameters(),
                                                weight_decay=self.l2_const)
+        # 评估缓存：局面 --> (合法动作, 合法动作的概率, 状态价值)，模型参数改变时清空
+        self.eval_cache = LRUCache(CONFIG['eval_cache_size'])
         if model_file:
-            net_params = paddle.load(model_file)
-            self.policy_value_net.set_state_dict(net_params)
+            self.load_model(model_file)
+
+    # 加载模型参数，旧参数的评估结果全部作废
+    def load_model(self, model_file):
+        net_params = paddle.load(model_file)
+        self.policy_value_net.set_state_dict(net_params)
+        self.eval_cache.clear()
 
     # 输入一个批次的状态，输出一个批次的动作概率和状态价值
     def policy_value(self, state_batch):
@@ -113,8 +123,17 @@ class PolicyValueNet:
         act_probs = np.exp(log_act_probs.numpy())
         return act_probs, value.numpy()
 
+    # 评估缓存的键：网络输入还包含最后一步走子，合法走子还受禁止重复的走法影响
+    def _eval_cache_key(self, board):
+        return board.zobrist_key, board.last_move, board.banned_move()
+
     # 输入棋盘，返回每个合法动作的（动作，概率）元组列表，以及棋盘状态的分数
     def policy_value_fn(self, board):
+        cache_key = self._eval_cache_key(board)
+        cached = self.eval_cache.get(cache_key)
+        if cached is not None:
+            legal_positions, legal_probs, value = cached
+            return zip(legal_positions, legal_probs), value
         self.policy_value_net.eval()
         # 获取合法动作列表
         legal_positions = board.availables
@@ -124,9 +143,39 @@ class PolicyValueNet:
         log_act_probs, value = self.policy_value_net(current_state)
         act_probs = np.exp(log_act_probs.numpy().flatten())
         # 只取出合法动作
-        act_probs = zip(legal_positions, act_probs[legal_positions])
+        legal_probs = act_probs[legal_positions]
+        value = value.numpy()
+        self.eval_cache.put(cache_key, (legal_positions, legal_probs, value))
         # 返回动作概率，以及状态价值
-        return act_probs, value.numpy()
+        return zip(legal_positions, legal_probs), value
+
+    # 输入多个棋盘，一次前向计算全部评估，返回每个棋盘的（（动作，概率）元组列表，状态分数）
+    # 评估缓存中已有的棋盘不再送入网络
+    def policy_value_batch(self, boards):
+        results = [None] * len(boards)
+        cache_keys = [self._eval_cache_key(board) for board in boards]
+        misses = []
+        for i, cache_key in enumerate(cache_keys):
+            cached = self.eval_cache.get(cache_key)
+            if cached is None:
+                misses.append(i)
+            else:
+                results[i] = (zip(cached[0], cached[1]), cached[2])
+        if not misses:
+            return results
+        self.policy_value_net.eval()
+        state_batch = paddle.to_tensor(get_state_batch([boards[i] for i in misses]))
+        # 使用神经网络进行预测
+        log_act_probs, value = self.policy_value_net(state_batch)
+        act_probs = np.exp(log_act_probs.numpy())
+        value = value.numpy().reshape(-1)
+        # 每个棋盘只取出自己的合法动作
+        for j, i in enumerate(misses):
+            legal_positions = boards[i].availables
+            legal_probs = act_probs[j][legal_positions]
+            self.eval_cache.put(cache_keys[i], (legal_positions, legal_probs, value[j].item()))
+            results[i] = (zip(legal_positions, legal_probs), value[j].item())
+        return results
 
     # 得到模型参数
     def get_policy_param(self):
@@ -141,6 +190,8 @@ class PolicyValueNet:
     # 执行一步训练
     def train_step(self, state_batch, mcts_probs, winner_batch, lr=0.002):
         self.policy_value_net.train()
+        # 参数即将改变，缓存的评估结果作废
+        self.eval_cache.clear()
         # 包装变量
         state_batch = paddle.to_tensor(state_batch)
         mcts_probs = paddle.to_tensor(mcts_probs)
@@ -0,0 +1,170 @@
+"""走子生成的perft测试：统计固定深度内的叶子节点数，验证走子生成的正确性并测量生成速度"""
+
+
+import argparse
+import time
+
+from game import Board, state_list_init, color2sign, get_pseudo_legal_moves, get_legal_moves, \
+    move_id2move_action, move_from_sq_list, move_to_sq_list, KING
+from state_machine import StateMachine
+
+
+# 简写棋盘：大写为红方，小写为黑方，'.'为空位，第一行是红方底线，和state_list_init的方向一致
+char2string = dict(R='红车', N='红马', B='红象', A='红士', K='红帅', C='红炮', P='红兵',
+                   r='黑车', n='黑马', b='黑象', a='黑士', k='黑帅', c='黑炮', p='黑兵')
+char2string['.'] = '一一'
+
+
+def rows2state_list(rows):
+    return [[char2string[char] for char in row] for row in rows]
+
+
+# 固定的测试局面：名字 --> (列表棋盘, 走子方, {深度: 合法走子的节点数})
+# 开局的节点数和公开的中国象棋perft结果一致，其余局面的节点数由本文件的perft算出，
+# 并在深度较浅时和逐个走子后检查帅是否能被吃掉的暴力实现对照过
+perft_suite = {
+    'opening': (state_list_init, '红', {1: 44, 2: 1920, 3: 79666}),
+    'middlegame': (rows2state_list(['R.BAKA..R',
+                                    '.........',
+                                    '.CN..N.C.',
+                                    'P.P...P.P',
+                                    '....P....',
+                                    '......p..',
+                                    'p.p.p...p',
+                                    '.cn....c.',
+                                    '........r',
+                                    'r.bakabn.']), '黑', {1: 46, 2: 1925, 3: 85008}),
+    'check': (rows2state_list(['...AKA...',
+                               '.........',
+                               '....B....',
+                               '.........',
+                               '.........',
+                               '.........',
+                               '.........',
+                               '....R....',
+                               '...N.....',
+                               '...a.k...']), '黑', {1: 2, 2: 51, 3: 100, 4: 2398}),
+    'endgame': (rows2state_list(['...AK....',
+                                 '....A....',
+                                 '.........',
+                                 '.........',
+                                 '..C...P..',
+                                 '..p......',
+                                 '.........',
+                                 '...k.....',
+                                 '....a....',
+                                 '...a.....']), '红', {1: 14, 2: 67, 3: 960, 4: 5004}),
+}
+
+
+def new_board(state_list, current_player_color):
+    board = Board()
+    board.init_board(start_player=1, state_list=state_list, current_player_color=current_player_color)
+    return board
+
+
+# 当前局面的走子集合，legal=False时返回按StateMachine规则生成的走子：
+# 不检查是否送将，不禁止重复局面，也没有将帅照面的规则
+# 合法走子直接调用走子生成函数，不经过board.availables的缓存，否则测到的是缓存命中而不是走子生成
+def get_moves(board, legal=True):
+    if legal:
+        return get_legal_moves(board.board_array,
+                               board.piece_squares[color2sign[board.current_player_color]],
+                               board.current_player_color,
+                               board.zobrist_key,
+                               board.key_history[-4])
+    moves = get_pseudo_legal_moves(board.board_array,
+                                   board.piece_squares[color2sign[board.current_player_color]],
+                                   board.current_player_color,
+                                   board.zobrist_key,
+                                   None)
+    return [move for move in moves
+            if abs(board.board_array[move_from_sq_list[move]]) != KING
+            or abs(move_from_sq_list[move] - move_to_sq_list[move]) in (1, 9)]
+
+
+def perft(board, depth, legal=True):
+    if depth == 0:
+        return 1
+    moves = get_moves(board, legal)
+    if depth == 1:
+        return len(moves)
+    nodes = 0
+    for move in moves:
+        board.do_move(move)
+        nodes += perft(board, depth - 1, legal)
+        board.undo_move()
+    return nodes
+
+
+# 分别统计每一个根节点走子下面的节点数，方便和其他实现对照定位出错的走法
+def divide(board, depth, legal=True):
+    result = {}
+    for move in get_moves(board, legal):
+        board.do_move(move)
+        result[move_id2move_action[move]] = perft(board, depth - 1, legal)
+        board.undo_move()
+    return result
+
+
+# 对StateMachine做同样的统计，player为'红'或'黑'
+def perft_state_machine(state, player, depth):
+    if depth == 0:
+        return 1
+    next_player = '黑' if player == '红' else '红'
+    nodes = 0
+    for from_pos, to_pos in StateMachine.get_all_legal_mutates(state, player):
+        nodes += perft_state_machine(StateMachine.make_move(state, from_pos, to_pos), next_player, depth - 1)
+    return nodes
+
+
+def timed(func, *args):
+    start_time = time.perf_counter()
+    nodes = func(*args)
+    return nodes, max(time.perf_counter() - start_time, 1e-9)
+
+
+def run_suite(max_depth):
+    """跑完所有测试局面，打印节点数、耗时和每秒节点数，返回是否全部正确"""
+    all_passed = True
+    for name, (state_list, color, expected) in perft_suite.items():
+        for depth in sorted(expected):
+            if depth > max_depth:
+                continue
+            nodes, elapsed = timed(perft, new_board(state_list, color), depth)
+            passed = nodes == expected[depth]
+            all_passed = all_passed and passed
+            print('{:<12} depth {}  nodes {:>9}  expected {:>9}  {:>8.3f}s  {:>10.0f} nps  {}'.format(
+                name, depth, nodes, expected[depth], elapsed, nodes / elapsed, 'OK' if passed else 'FAIL'))
+    return all_passed
+
+
+def run_state_machine_check(max_depth):
+    """按StateMachine的规则统计两个实现的节点数，互相验证并比较速度"""
+    all_passed = True
+    for name, (state_list, color, _) in perft_suite.items():
+        for depth in range(1, max_depth + 1):
+            nodes, elapsed = timed(perft, new_board(state_list, color), depth, False)
+            sm_nodes, sm_elapsed = timed(perft_state_machine, state_list, color, depth)
+            passed = nodes == sm_nodes
+            all_passed = all_passed and passed
+            print('{:<12} depth {}  Board {:>8} ({:>9.0f} nps)  StateMachine {:>8} ({:>7.0f} nps)  {}'.format(
+                name, depth, nodes, nodes / elapsed, sm_nodes, sm_nodes / sm_elapsed, 'OK' if passed else 'FAIL'))
+    return all_passed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='中国象棋走子生成的perft测试')
+    parser.add_argument('--depth', type=int, default=3, help='测试的最大深度')
+    parser.add_argument('--divide', metavar='NAME', help='打印指定局面每个根节点走子下的节点数')
+    parser.add_argument('--state-machine', action='store_true', help='和StateMachine对照节点数和速度')
+    args = parser.parse_args()
+
+    if args.divide:
+        state_list, color, _ = perft_suite[args.divide]
+        for action, nodes in sorted(divide(new_board(state_list, color), args.depth).items()):
+            print(action, nodes)
+    elif args.state_machine:
+        raise SystemExit(0 if run_state_machine_check(args.depth) else 1)
+    else:
+        raise SystemExit(0 if run_suite(args.depth) else 1)
@@ -12,7 +12,13 @@ else:
 
 # 测试Board中的start_play
 class Human1:
+    def __init__(self, opponent=None):
+        # 等待输入的时候，对手AI在后台继续思考
+        self.opponent = opponent
+
     def get_action(self, board):
+        if self.opponent is not None:
+            self.opponent.start_ponder(board)
         move = move_action2move_id[input('请输入')]
         # move = random.choice(board.availables)
         return move
@@ -30,9 +36,14 @@ else:
 mcts_player = MCTSPlayer(policy_value_net.policy_value_fn,
                                 c_puct=5,
                                 n_playout=100,
-                                is_selfplay=0)
-
-human = Human1()
+                                is_selfplay=0,
+                                policy_value_batch_function=policy_value_net.policy_value_batch,
+                                n_threads=CONFIG['search_threads'],
+                                transposition_table_size=CONFIG['transposition_table_size'],
+                                time_budget=CONFIG['time_budget'],
+                                memory_limit=CONFIG['tree_memory_mb'] * 2 ** 20)
+
+human = Human1(mcts_player)
 
 
 game = Game(board=Board())